@@ -0,0 +1,684 @@
+"""
+Throughput and memory benchmarks of rbm.py and dbn.py on synthetic MNIST-shaped data (no download needed).
+
+ > python benchmark.py                      run all cases, write benchmark_results.json
+ > python benchmark.py --quick              first value of every grid axis only
+ > python benchmark.py --case cd1           only the cases whose name starts with "cd1"
+ > python benchmark.py --save-baseline      also store the results as benchmark_baseline.json
+ > python benchmark.py --check              compare the wake-sleep step and the top rbm sampling with the unfused
+                                            references and check that a float32 net computes in float32 only, first
+
+Every case runs in a fresh process so that the reported peak RSS belongs to that case only. If a baseline file
+exists, every result is compared with it and cases whose throughput dropped by more than --tolerance are flagged
+(exit code 1).
+"""
+from util import *
+from rbm import RestrictedBoltzmannMachine
+from dbn import DeepBeliefNet
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+IMAGE_SIZE = [28, 28]
+N_LABELS = 10
+
+
+def synthetic_mnist(n_samples, dim=None, n_labels=N_LABELS, seed=0, dtype=np.float64, density=0.19, noise=None):
+    """
+    Random images with roughly the density of MNIST (about 19% non-zero pixels by default) and one-hot labels.
+    With "noise", the images are learnable instead: a random binary prototype per label with every pixel flipped
+    with probability "noise".
+    """
+    if dim is None:
+        dim = IMAGE_SIZE
+    rng = np.random.default_rng(seed)
+
+    lbls = rng.integers(0, n_labels, n_samples)
+    if noise is None:
+        imgs = rng.random((n_samples, dim[0] * dim[1]))
+        imgs[imgs < 1. - density] = 0.
+    else:
+        prototypes = rng.random((n_labels, dim[0] * dim[1])) < density
+        imgs = (prototypes[lbls] ^ (rng.random((n_samples, dim[0] * dim[1])) < noise)).astype(np.float64)
+
+    lbls_1hot = np.zeros((n_samples, n_labels), dtype=dtype)
+    lbls_1hot[range(n_samples), lbls] = 1.
+
+    return imgs.astype(dtype, copy=False), lbls_1hot
+
+
+def dbn_sizes(ndim_hidden):
+    return [IMAGE_SIZE[0] * IMAGE_SIZE[1], ndim_hidden, ndim_hidden, 2000]
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process (ru_maxrss is in kilobytes on linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def blas_threads():
+    """
+    Number of BLAS threads numpy uses. Needs threadpoolctl, otherwise falls back to the usual environment variables
+    (None if none is set).
+    """
+    try:
+        from threadpoolctl import threadpool_info
+        return max([pool["num_threads"] for pool in threadpool_info() if pool["user_api"] == "blas"] or [None])
+    except ImportError:
+        for variable in ["OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "OMP_NUM_THREADS"]:
+            if variable in os.environ:
+                return int(os.environ[variable])
+        return None
+
+
+def run_isolated(func, **kwargs):
+    """
+    Run func(**kwargs) in a freshly spawned process and return its result
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(func, **kwargs).result()
+
+
+def timed(func, n_samples, n_batches):
+    """
+    Run func() and return samples/sec, milliseconds per minibatch, peak RSS and BLAS thread count
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+
+    return {"samples_per_sec": n_samples / elapsed, "ms_per_batch": 1000. * elapsed / max(n_batches, 1),
+            "peak_rss_mb": peak_rss_mb(), "blas_threads": blas_threads()}
+
+
+def bench_cd1(n_samples, ndim_hidden, batch_size, in_place, monitor=True, dtype="float64", prefetch=False):
+    """
+    One epoch of cd1 on the bottom rbm, optionally with the random numbers drawn on a background thread
+    """
+    imgs, _ = synthetic_mnist(n_samples, dtype=dtype)
+    rbm = RestrictedBoltzmannMachine(ndim_visible=imgs.shape[1], ndim_hidden=ndim_hidden, is_bottom=True,
+                                     image_size=IMAGE_SIZE, batch_size=batch_size, dtype=dtype, seed=0)
+    rbm.random = RandomStream(0, dtype=dtype, prefetch=prefetch)
+
+    n_batches = n_samples // batch_size
+    return timed(lambda: rbm.cd1(imgs, n_iterations=1, in_place=in_place, monitor=monitor),
+                 n_batches * batch_size, n_batches)
+
+
+def bench_sampler(n_samples, batch_size, order, memmap, block_size=1000):
+    """
+    One epoch of minibatches drawn by util.MinibatchSampler from the images in memory or memory-mapped from a .npy
+    file, in their order ("sequential"), fully shuffled ("shuffled") or shuffled in blocks of "block_size" rows
+    ("blocks")
+    """
+    imgs, _ = synthetic_mnist(n_samples)
+    with tempfile.TemporaryDirectory() as directory:
+        if memmap:
+            np.save(os.path.join(directory, "imgs.npy"), imgs)
+            imgs = np.load(os.path.join(directory, "imgs.npy"), mmap_mode="r")
+        sampler = MinibatchSampler([imgs], batch_size, seed=0, block_size=block_size if order == "blocks" else None,
+                                   shuffle=order != "sequential")
+
+        def epoch():
+            for minibatch in sampler.epoch(0):
+                pass
+
+        return timed(epoch, n_samples, len(sampler))
+
+
+def bench_optimizer(n_samples, ndim_hidden, batch_size, learning_rate, momentum, weight_decay=0., target=1.375,
+                    max_epochs=15, noise=0.05):
+    """
+    Epochs of cd1 (in place) until the epoch reconstruction loss of the bottom rbm reaches "target" on learnable
+    synthetic data, at most "max_epochs". Momentum 0 is the plain update. Adds "epochs_to_target" (nan if the target
+    was not reached) and the "final_loss"
+    """
+    imgs, _ = synthetic_mnist(n_samples, noise=noise)
+    np.random.seed(0)
+    rbm = RestrictedBoltzmannMachine(ndim_visible=imgs.shape[1], ndim_hidden=ndim_hidden, is_bottom=True,
+                                     image_size=IMAGE_SIZE, batch_size=batch_size, seed=0)
+    rbm.learning_rate, rbm.momentum, rbm.weight_decay = learning_rate, momentum, weight_decay
+
+    losses = []
+    n_batches = n_samples // batch_size
+    result = timed(lambda: losses.extend(rbm.cd1(imgs, n_iterations=max_epochs, in_place=True)),
+                   n_batches * batch_size * max_epochs, n_batches * max_epochs)
+    reached = [epoch + 1 for epoch, loss in enumerate(losses) if loss <= target]
+    result["epochs_to_target"] = float(reached[0]) if reached else float("nan")
+    result["final_loss"] = losses[-1]
+    return result
+
+
+def bench_top_cd(ndim_hidden, cd_k, n_fantasy, target=0.99, max_epochs=8, n_train=3000, n_test=1000, noise=0.2):
+    """
+    Epochs and seconds of CD-k ("n_fantasy" 0) or PCD-k training of the top rbm until the test accuracy of
+    DeepBeliefNet.recognize_meanfield reaches "target", at most "max_epochs". The rbms below are trained for two
+    epochs on learnable synthetic data first (not timed), the accuracy is evaluated after every epoch (not timed).
+    Adds "epochs_to_target" and "seconds_to_target" (nan if not reached) and the last "accuracy"
+    """
+    os.chdir(tempfile.mkdtemp())
+    imgs, lbls = synthetic_mnist(n_train + n_test, noise=noise)
+    test_imgs, test_lbls = imgs[n_train:], np.argmax(lbls[n_train:], axis=1)
+    dbn = DeepBeliefNet(sizes=dbn_sizes(ndim_hidden), image_size=IMAGE_SIZE, n_labels=N_LABELS, batch_size=20,
+                        seed=0)
+    vis_hid, hid_pen, top = dbn.rbm_stack["vis--hid"], dbn.rbm_stack["hid--pen"], dbn.rbm_stack["pen+lbl--top"]
+    vis_hid.cd1(imgs[:n_train], n_iterations=2, in_place=True)
+    vis_hid.untwine_weights()
+    hid = dbn.propagate_cached("vis--hid", imgs[:n_train])
+    hid_pen.cd1(hid, n_iterations=2, in_place=True)
+    hid_pen.untwine_weights()
+    pen_lbl = np.array(dbn.propagate_cached("hid--pen", hid, append=lbls[:n_train]))
+
+    top.cd_k, top.n_fantasy = cd_k, n_fantasy
+    elapsed, accuracy, reached = 0., 0., None
+    for epoch in range(max_epochs):
+        start = time.perf_counter()
+        top.cd1(pen_lbl, n_iterations=1, in_place=True, monitor=False)
+        elapsed += time.perf_counter() - start
+        accuracy = float(np.mean(np.argmax(dbn.recognize_meanfield(test_imgs), axis=1) == test_lbls))
+        if accuracy >= target:
+            reached = (epoch + 1, elapsed)
+            break
+
+    n_batches = (epoch + 1) * (n_train // top.batch_size)
+    return {"samples_per_sec": n_batches * top.batch_size / elapsed, "ms_per_batch": 1000. * elapsed / n_batches,
+            "peak_rss_mb": peak_rss_mb(), "blas_threads": blas_threads(),
+            "epochs_to_target": float(reached[0]) if reached else float("nan"),
+            "seconds_to_target": reached[1] if reached else float("nan"), "accuracy": accuracy}
+
+
+def bench_cd1_sparse(n_samples, ndim_hidden, batch_size, density, sparse_input):
+    """
+    One epoch of cd1 on the bottom rbm with visible data of the given density, dense or sparse products
+    """
+    imgs, _ = synthetic_mnist(n_samples, density=density)
+    rbm = RestrictedBoltzmannMachine(ndim_visible=imgs.shape[1], ndim_hidden=ndim_hidden, is_bottom=True,
+                                     image_size=IMAGE_SIZE, batch_size=batch_size)
+    rbm.sparse_input = sparse_input
+
+    n_batches = n_samples // batch_size
+    return timed(lambda: rbm.cd1(imgs, n_iterations=1), n_batches * batch_size, n_batches)
+
+
+def bench_cd1_parallel(n_samples, ndim_hidden, batch_size, n_workers):
+    """
+    One epoch of data-parallel cd1 on the bottom rbm. Peak RSS is that of the parent process only
+    """
+    imgs, _ = synthetic_mnist(n_samples)
+    rbm = RestrictedBoltzmannMachine(ndim_visible=imgs.shape[1], ndim_hidden=ndim_hidden, is_bottom=True,
+                                     image_size=IMAGE_SIZE, batch_size=batch_size)
+
+    n_batches = n_samples // (batch_size * n_workers) * n_workers
+    return timed(lambda: rbm.cd1_parallel(imgs, n_iterations=1, n_workers=n_workers, seed=0),
+                 n_batches * batch_size, n_batches)
+
+
+def bench_recognize(n_samples, ndim_hidden, chunk_size, n_threads):
+    """
+    DeepBeliefNet.recognize with an untrained net (the cost does not depend on the weights). A minibatch is a chunk
+    """
+    imgs, lbls = synthetic_mnist(n_samples)
+    dbn = DeepBeliefNet(sizes=dbn_sizes(ndim_hidden), image_size=IMAGE_SIZE, n_labels=N_LABELS, batch_size=20)
+    for name in ["vis--hid", "hid--pen"]:
+        dbn.rbm_stack[name].untwine_weights()
+
+    return timed(lambda: dbn.recognize(imgs, lbls, chunk_size=chunk_size, n_threads=n_threads),
+                 n_samples, -(-n_samples // chunk_size))
+
+
+def bench_recognize_mode(n_samples, ndim_hidden, mode, tol=1e-3, n_train=2000, noise=0.2):
+    """
+    DeepBeliefNet.recognize in "sampling", "meanfield" or "freeenergy" mode with a net trained greedily for one
+    epoch on learnable synthetic data (not timed). Adds the test accuracy and, for mean-field, the mean number of top
+    rbm iterations and "agreement_full", the fraction of samples whose label at the early exit is the label after all
+    n_gibbs_recog iterations.
+    """
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("trained_rbm")
+    imgs, lbls = synthetic_mnist(n_train + n_samples, noise=noise)
+    dbn = DeepBeliefNet(sizes=dbn_sizes(ndim_hidden), image_size=IMAGE_SIZE, n_labels=N_LABELS, batch_size=20,
+                        seed=0)
+    dbn.train_greedylayerwise(imgs[:n_train], lbls[:n_train], n_iterations=1)
+    test_imgs, test_lbls = imgs[n_train:], lbls[n_train:]
+
+    predicted = []
+    result = timed(lambda: predicted.append(dbn.recognize(test_imgs, test_lbls, mode=mode, tol=tol)[0]),
+                   n_samples, 1)
+    result["accuracy"] = float(np.mean(predicted[0] == np.argmax(test_lbls, axis=1)))
+    if mode == "meanfield":
+        probabilities, iterations = dbn.recognize_meanfield(test_imgs, tol=tol, return_iterations=True)
+        result["mean_iterations"] = float(np.mean(iterations))
+        result["agreement_full"] = float(np.mean(np.argmax(probabilities, axis=1) ==
+                                                 np.argmax(dbn.recognize_meanfield(test_imgs), axis=1)))
+    return result
+
+
+def bench_generate(ndim_hidden, n_samples, record_period):
+    """
+    DeepBeliefNet.generate_batch for all labels with "n_samples" chains each. A minibatch is a Gibbs step, a sample
+    is one Gibbs step of one chain
+    """
+    dbn = DeepBeliefNet(sizes=dbn_sizes(ndim_hidden), image_size=IMAGE_SIZE, n_labels=N_LABELS, batch_size=20)
+    for name in ["vis--hid", "hid--pen"]:
+        dbn.rbm_stack[name].untwine_weights()
+
+    return timed(lambda: dbn.generate_batch(np.eye(N_LABELS), n_samples=n_samples, record_period=record_period),
+                 N_LABELS * n_samples * dbn.n_gibbs_gener, dbn.n_gibbs_gener)
+
+
+def bench_generate_tempering(ndim_hidden, n_replicas, n_steps, n_samples=10, beta_min=0.9, n_train=2000, n_epochs=5,
+                             noise=0.2):
+    """
+    Time to quality of DeepBeliefNet.generate_batch with "n_replicas" parallel tempering replicas (1 is plain Gibbs
+    sampling) for a net trained greedily for "n_epochs" on learnable synthetic data (not timed). Adds the
+    "label_accuracy", the fraction of final samples that the net itself recognizes as their clamped label
+    (DeepBeliefNet.recognize_meanfield), and the mean swap acceptance rate
+    """
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("trained_rbm")
+    imgs, lbls = synthetic_mnist(n_train, noise=noise)
+    dbn = DeepBeliefNet(sizes=dbn_sizes(ndim_hidden), image_size=IMAGE_SIZE, n_labels=N_LABELS, batch_size=20,
+                        seed=0)
+    dbn.train_greedylayerwise(imgs, lbls, n_iterations=n_epochs)
+    dbn.n_gibbs_gener = n_steps
+
+    records = []
+    result = timed(lambda: records.append(dbn.generate_batch(np.eye(N_LABELS), n_samples=n_samples,
+                                                             record_period=n_steps, n_replicas=n_replicas,
+                                                             beta_min=beta_min)),
+                   N_LABELS * n_samples * n_steps, n_steps)
+    recognized = np.argmax(dbn.recognize_meanfield(records[0][-1]), axis=1)
+    result["label_accuracy"] = float(np.mean(recognized == np.repeat(np.arange(N_LABELS), n_samples)))
+    result["swap_acceptance"] = float(np.mean(dbn.swap_acceptance)) if n_replicas > 1 else float("nan")
+    return result
+
+
+def wakesleep_dbn(ndim_hidden, batch_size, seed=0):
+    """
+    Untrained net ready for wake-sleep (the cost does not depend on the weights)
+    """
+    dbn = DeepBeliefNet(sizes=dbn_sizes(ndim_hidden), image_size=IMAGE_SIZE, n_labels=N_LABELS, batch_size=batch_size,
+                        seed=seed)
+    for name in ["vis--hid", "hid--pen"]:
+        dbn.rbm_stack[name].untwine_weights()
+    return dbn
+
+
+def wakesleep_step_reference(dbn, vis_minibatch, lbl_minibatch):
+    """
+    The unfused wake-sleep step, as DeepBeliefNet.train_wakesleep_finetune ran it before '_wakesleep_step': every
+    pass samples, every call allocates
+    """
+    n_labels = lbl_minibatch.shape[1]
+    rbm_stack = dbn.rbm_stack
+
+    p_hid_wake, lbl_hid_wake = rbm_stack['vis--hid'].get_h_given_v_dir(vis_minibatch)
+    p_pen_wake, lbl_pen_wake = rbm_stack['hid--pen'].get_h_given_v_dir(lbl_hid_wake)
+    lbl_pen = np.concatenate((lbl_pen_wake, lbl_minibatch), axis=1)
+    p_wake, lbl_wake = rbm_stack['pen+lbl--top'].get_h_given_v(lbl_pen)
+
+    lbl_pen_0 = np.copy(lbl_pen)
+
+    lbl_neg = lbl_wake
+    for _ in range(dbn.n_gibbs_wakesleep):
+        p_pen_neg, lbl_pen_neg = rbm_stack['pen+lbl--top'].get_v_given_h(lbl_neg)
+        p_neg, lbl_neg = rbm_stack['pen+lbl--top'].get_h_given_v(lbl_pen_neg)
+
+    lbl_pen_sleep = lbl_pen_neg[:, :-n_labels]
+    p_hid_sleep, lbl_hid_sleep = rbm_stack['hid--pen'].get_v_given_h_dir(lbl_pen_sleep)
+    p_vis_sleep, lbl_vis_sleep = rbm_stack['vis--hid'].get_v_given_h_dir(lbl_hid_sleep)
+
+    pred_p_pen_sleep, pred_lbl_pen_sleep = rbm_stack['hid--pen'].get_h_given_v_dir(lbl_hid_sleep)
+    pred_p_hid_sleep, pred_lbl_hid_sleep = rbm_stack['vis--hid'].get_h_given_v_dir(lbl_vis_sleep)
+    pred_p_vis, pred_lbl_vis = rbm_stack['vis--hid'].get_v_given_h_dir(lbl_hid_wake)
+    pred_p_hid, pred_lbl_hid = rbm_stack['hid--pen'].get_v_given_h_dir(lbl_pen_wake)
+
+    rbm_stack['vis--hid'].update_generate_params(lbl_hid_wake, vis_minibatch, pred_p_vis)
+    rbm_stack['hid--pen'].update_generate_params(lbl_pen_wake, p_hid_wake, pred_p_hid)
+
+    lbl_pen = np.concatenate((lbl_pen_wake, lbl_minibatch), axis=1)
+    rbm_stack['pen+lbl--top'].update_params(lbl_pen_0, lbl_wake, p_pen_neg, p_neg)
+
+    rbm_stack['hid--pen'].update_recognize_params(lbl_hid_sleep, lbl_pen_sleep, pred_lbl_pen_sleep)
+    rbm_stack['vis--hid'].update_recognize_params(p_vis_sleep, lbl_hid_sleep, pred_lbl_hid_sleep)
+
+
+def bench_wakesleep(n_samples, ndim_hidden, batch_size, reference=False):
+    """
+    One epoch of DeepBeliefNet.train_wakesleep_finetune, run in an empty directory so that nothing is loaded, or of
+    'wakesleep_step_reference'
+    """
+    os.chdir(tempfile.mkdtemp())
+    imgs, lbls = synthetic_mnist(n_samples)
+    dbn = wakesleep_dbn(ndim_hidden, batch_size)
+    os.makedirs("trained_dbn")
+
+    n_batches = n_samples // batch_size
+    if reference:
+        def run():
+            for it in range(n_batches):
+                batch = slice(it * batch_size, (it + 1) * batch_size)
+                wakesleep_step_reference(dbn, imgs[batch], lbls[batch])
+    else:
+        def run():
+            dbn.train_wakesleep_finetune(imgs, lbls, n_iterations=1, checkpoint=None)
+
+    return timed(run, n_batches * batch_size, n_batches)
+
+
+class FrozenStream(RandomStream):
+    """
+    Random stream that returns the same numbers on every call with a given shape. Two implementations that draw
+    different amounts of random numbers then still sample identically
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frozen = {}  # shape -> numbers
+
+    def uniform(self, shape):
+        if tuple(shape) not in self.frozen:
+            self.frozen[tuple(shape)] = self.generator.random(shape, dtype=self.dtype)
+        return self.frozen[tuple(shape)]
+
+
+def check_wakesleep(n_samples=400, ndim_hidden=200, batch_size=20, tolerance=1e-8):
+    """
+    Run DeepBeliefNet._wakesleep_step and 'wakesleep_step_reference' from the same initial net (fixed seed) on the same
+    minibatches and compare all parameters afterwards. Sampling uses FrozenStream, so the two runs only differ by
+    rounding. Also prints the peak memory traced during one minibatch of each. Returns True if they match
+    """
+    import tracemalloc
+
+    imgs, lbls = synthetic_mnist(n_samples)
+    nets, peaks = [], []
+    for reference in [True, False]:
+        np.random.seed(0)
+        dbn = wakesleep_dbn(ndim_hidden, batch_size)
+        for name in dbn.rbm_names:
+            dbn.rbm_stack[name].random = FrozenStream(0, dtype=dbn.rbm_stack[name].dtype)
+        buffers = None if reference else dbn._allocate_wakesleep_buffers(N_LABELS)
+
+        for it in range(n_samples // batch_size):
+            batch = slice(it * batch_size, (it + 1) * batch_size)
+            if it == 1:
+                tracemalloc.start()
+            if reference:
+                wakesleep_step_reference(dbn, imgs[batch], lbls[batch])
+            else:
+                dbn._wakesleep_step(imgs[batch], lbls[batch], buffers)
+            if it == 1:
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        nets.append(dbn)
+
+    deviation = 0.
+    for name in nets[0].rbm_stack:
+        for key in ["weight_vh", "weight_v_to_h", "weight_h_to_v", "bias_v", "bias_h"]:
+            reference, fused = getattr(nets[0].rbm_stack[name], key), getattr(nets[1].rbm_stack[name], key)
+            if reference is not None:
+                deviation = max(deviation, float(np.max(np.abs(reference - fused))))
+
+    print("wake-sleep check: max parameter deviation %.3g after %d minibatches, peak traced memory per minibatch "
+          "%.2f MB (reference) / %.2f MB (fused)" % (deviation, n_samples // batch_size, peaks[0] / 2. ** 20,
+                                                     peaks[1] / 2. ** 20))
+    return deviation <= tolerance
+
+
+# 99% critical value of the chi-square distribution with 9 degrees of freedom (10 categories)
+CHI2_CRITICAL_99_DF9 = 21.666
+
+
+def chi_square(counts, probabilities):
+    """
+    Pearson's chi-square statistic of the category "counts" against the expected "probabilities"
+    """
+    expected = np.sum(counts) * probabilities
+    return float(np.sum((counts - expected) ** 2 / expected))
+
+
+def check_sampling(n_draws=200000, ndim_data=20, ndim_hidden=15, tolerance=1e-12, seed=0):
+    """
+    Check the fused visible activation of the top rbm ('_visible_activation_inplace' through get_v_given_h):
+
+     - its probabilities against the unfused sigmoid and softmax on random supports, with and without out= buffers,
+       and sample_categorical against the unfused cumulative-sum sampling on the same random numbers;
+     - the label frequencies of "n_draws" samples of one hidden state, and of sample_categorical, with a chi-square
+       test at the 99% level;
+     - that supports of +-1000 give finite probabilities summing to one and one-hot label activations.
+
+    Returns True if all pass
+    """
+    rng = np.random.default_rng(seed)
+    np.random.seed(seed)
+    top = RestrictedBoltzmannMachine(ndim_visible=ndim_data + N_LABELS, ndim_hidden=ndim_hidden, is_top=True,
+                                     n_labels=N_LABELS, batch_size=20, seed=seed)
+    top.weight_vh = rng.normal(scale=1., size=top.weight_vh.shape)
+    top.bias_v = rng.normal(scale=1., size=top.bias_v.shape)
+
+    # probabilities of the fused kernel against the unfused formulas
+    hidden = (rng.random((100, ndim_hidden)) < 0.5).astype(np.float64)
+    support = hidden @ top.weight_vh.T + top.bias_v
+    reference = 1. / (1. + np.exp(-support))
+    reference[:, -N_LABELS:] = np.exp(support[:, -N_LABELS:]) / np.sum(np.exp(support[:, -N_LABELS:]), axis=1,
+                                                                        keepdims=True)
+    fused = top.get_v_given_h(hidden)[0]
+    fused_out = top.get_v_given_h(hidden, out=(np.empty_like(support), np.empty_like(support)))[0]
+    deviation = max(float(np.max(np.abs(fused - reference))), float(np.max(np.abs(fused_out - reference))))
+
+    probabilities = reference[:, -N_LABELS:]
+    rand = rng.random(probabilities.shape[0])
+    category = np.minimum(np.sum(np.cumsum(probabilities, axis=1) < rand.reshape(-1, 1), axis=1), N_LABELS - 1)
+    same_samples = bool(np.all(np.argmax(sample_categorical(probabilities, rand=rand), axis=1) == category))
+
+    # label frequencies of many samples of a single hidden state
+    activations = top.get_v_given_h(np.repeat(hidden[:1], n_draws, axis=0))[1]
+    chi2_kernel = chi_square(np.sum(activations[:, -N_LABELS:], axis=0), probabilities[0])
+    draws = sample_categorical(np.repeat(probabilities[:1], n_draws, axis=0), rand=rng.random(n_draws))
+    chi2_categorical = chi_square(np.sum(draws, axis=0), probabilities[0])
+
+    # extreme supports
+    extreme = np.where(rng.random((50, top.ndim_visible)) < 0.5, -1000., 1000.)
+    extreme_activations = np.empty_like(extreme)
+    with np.errstate(over="ignore"):
+        top._visible_activation_inplace(extreme, extreme_activations)
+    finite = bool(np.all(np.isfinite(extreme)) and np.allclose(np.sum(extreme[:, -N_LABELS:], axis=1), 1.) and
+                  np.all(np.sum(extreme_activations[:, -N_LABELS:], axis=1) == 1.))
+
+    passed = deviation <= tolerance and same_samples and chi2_kernel < CHI2_CRITICAL_99_DF9 and \
+        chi2_categorical < CHI2_CRITICAL_99_DF9 and finite
+    print("sampling check: max probability deviation %.3g, same categorical samples %s, chi-square %.2f (kernel) / "
+          "%.2f (sample_categorical) against %.2f, finite at +-1000 %s"
+          % (deviation, same_samples, chi2_kernel, chi2_categorical, CHI2_CRITICAL_99_DF9, finite))
+    return passed
+
+
+# rbm functions the training and recognition loops go through, their array arguments and results are checked by
+# 'check_dtype'
+HOT_PATH = ["get_h_given_v", "get_v_given_h", "get_h_given_v_dir", "get_v_given_h_dir", "update_params",
+            "apply_update", "update_generate_params", "update_recognize_params", "advance_fantasy",
+            "classify_free_energy"]
+
+
+def float_arrays(value):
+    """
+    Floating point arrays in "value" (an array, or tuples, lists and dicts of them)
+    """
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [array for item in value for array in float_arrays(item)]
+    if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.floating):
+        return [value]
+    return []
+
+
+def check_dtype(dtype="float32", n_samples=200, ndim_hidden=50, batch_size=20):
+    """
+    Train a DeepBeliefNet in "dtype" on synthetic data, greedily and then with wake-sleep for one epoch each, and
+    recognize in every mode. Every floating point array passed to or returned by the HOT_PATH functions of the rbms,
+    every parameter, velocity and workspace buffer, the wake-sleep buffers and the recognized probabilities must be
+    of "dtype". Prints the offenders and returns True if there are none
+    """
+    dtype = np.dtype(dtype)
+    offenders = set()
+
+    def check(where, value):
+        for array in float_arrays(value):
+            if array.dtype != dtype:
+                offenders.add("%s: %s" % (where, array.dtype))
+
+    def checked(where, func):
+        def wrapper(*args, **kwargs):
+            check(where + " argument", [args, kwargs])
+            result = func(*args, **kwargs)
+            check(where + " result", result)
+            return result
+        return wrapper
+
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        os.makedirs("trained_rbm")
+        os.makedirs("trained_dbn")
+        imgs, lbls = synthetic_mnist(n_samples, dtype=dtype, noise=0.2)
+        dbn = DeepBeliefNet(sizes=[imgs.shape[1], ndim_hidden, ndim_hidden, 2 * ndim_hidden], image_size=IMAGE_SIZE,
+                            n_labels=N_LABELS, batch_size=batch_size, dtype=dtype, seed=0)
+        for name in dbn.rbm_names:
+            rbm = dbn.rbm_stack[name]
+            for func in HOT_PATH:
+                setattr(rbm, func, checked("rbm[%s].%s" % (name, func), getattr(rbm, func)))
+
+        dbn.train_greedylayerwise(imgs, lbls, n_iterations=1)
+        dbn.train_wakesleep_finetune(imgs, lbls, n_iterations=1, checkpoint=None)
+        buffers = dbn._allocate_wakesleep_buffers(N_LABELS)
+        dbn._wakesleep_step(imgs[:batch_size], lbls[:batch_size], buffers)
+        check("wake-sleep buffers", buffers)
+
+        for mode in ["sampling", "meanfield", "freeenergy"]:
+            dbn.recognize(imgs, lbls, mode=mode)
+        check("recognize_meanfield", dbn.recognize_meanfield(imgs))
+        check("recognize_free_energy", dbn.recognize_free_energy(imgs))
+
+        for name in dbn.rbm_names:
+            rbm = dbn.rbm_stack[name]
+            check("rbm[%s] state" % name, rbm.get_state())
+            check("rbm[%s] workspace" % name, rbm.workspace)
+            if rbm.random.dtype != dtype:
+                offenders.add("rbm[%s] random stream: %s" % (name, rbm.random.dtype))
+    finally:
+        os.chdir(cwd)
+
+    print("%s check: %d arrays of another dtype%s" % (dtype, len(offenders),
+                                                       "".join("\n  " + where for where in sorted(offenders))))
+    return not offenders
+
+
+# name, benchmark function, grid of keyword arguments (every combination is run, --quick runs the first values only)
+CASES = [
+    ("cd1", bench_cd1, {"n_samples": [10000, 60000], "ndim_hidden": [500, 200], "batch_size": [20, 100],
+                        "in_place": [False, True], "dtype": ["float64", "float32"]}),
+    ("cd1_monitor", bench_cd1, {"n_samples": [10000], "ndim_hidden": [500], "batch_size": [20],
+                                "in_place": [False, True], "monitor": [False, True]}),
+    ("cd1_prefetch", bench_cd1, {"n_samples": [10000], "ndim_hidden": [500], "batch_size": [20, 100],
+                                 "in_place": [True], "dtype": ["float64", "float32"], "prefetch": [False, True]}),
+    ("sampler", bench_sampler, {"n_samples": [60000], "batch_size": [20, 100],
+                                "order": ["sequential", "shuffled", "blocks"], "memmap": [False, True]}),
+    ("optimizer", bench_optimizer, {"n_samples": [1000], "ndim_hidden": [500], "batch_size": [20],
+                                    "learning_rate": [0.01, 0.003, 0.001], "momentum": [0., 0.5, 0.7, 0.9],
+                                    "weight_decay": [0., 1e-4]}),
+    ("top_cd", bench_top_cd, {"ndim_hidden": [500], "cd_k": [1, 3], "n_fantasy": [0, 20, 100]}),
+    ("cd1_sparse", bench_cd1_sparse, {"n_samples": [10000], "ndim_hidden": [500], "batch_size": [20, 100],
+                                      "density": [0.19, 0.1, 0.05, 0.02], "sparse_input": [False, True]}),
+    ("cd1_parallel", bench_cd1_parallel, {"n_samples": [10000], "ndim_hidden": [500], "batch_size": [20],
+                                          "n_workers": [1, 2, 4, 8]}),
+    ("recognize", bench_recognize, {"n_samples": [10000, 60000], "ndim_hidden": [500], "chunk_size": [1000],
+                                    "n_threads": [1, 4]}),
+    ("recognize_mode", bench_recognize_mode, {"n_samples": [10000], "ndim_hidden": [500], "mode": ["sampling",
+                                                                                                 "meanfield",
+                                                                                                 "freeenergy"]}),
+    ("recognize_meanfield_tol", bench_recognize_mode, {"n_samples": [10000], "ndim_hidden": [500],
+                                                       "mode": ["meanfield"], "tol": [None, 1e-2, 1e-3, 1e-5]}),
+    ("recognize_unchunked", bench_recognize, {"n_samples": [10000], "ndim_hidden": [500], "chunk_size": [10000],
+                                              "n_threads": [1]}),
+    ("generate", bench_generate, {"ndim_hidden": [500], "n_samples": [1, 10], "record_period": [1, 10]}),
+    ("generate_tempering", bench_generate_tempering, {"ndim_hidden": [500], "n_replicas": [1, 4, 8],
+                                                      "n_steps": [10, 100, 600]}),
+    ("wakesleep", bench_wakesleep, {"n_samples": [2000, 10000], "ndim_hidden": [500, 200], "batch_size": [20, 100],
+                                    "reference": [False, True]}),
+]
+
+
+def case_key(name, params):
+    return "%s(%s)" % (name, ", ".join("%s=%s" % (key, params[key]) for key in sorted(params)))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Flag every result whose samples/sec dropped by more than "tolerance" (relative) below the baseline.
+    Returns the keys of the regressed cases
+    """
+    regressions = []
+    for key, result in results.items():
+        if key in baseline and result["samples_per_sec"] < (1. - tolerance) * baseline[key]["samples_per_sec"]:
+            regressions.append(key)
+            print("REGRESSION %s: %.2f samples/sec, baseline %.2f" % (key, result["samples_per_sec"],
+                                                                      baseline[key]["samples_per_sec"]))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="run the first value of every grid axis only")
+    parser.add_argument("--case", default="", help="run only the cases whose name starts with this")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative throughput drop flagged as regression")
+    parser.add_argument("--check", action="store_true",
+                        help="check the fused kernels and float32 computation first")
+    args = parser.parse_args()
+
+    if args.check:
+        for check in [check_wakesleep, check_sampling, check_dtype]:
+            if not check():
+                print("%s FAILED" % check.__name__)
+                exit(1)
+
+    results = {}
+    for name, func, grid in CASES:
+        if not name.startswith(args.case):
+            continue
+        axes = [[values[0]] if args.quick else values for values in grid.values()]
+        for values in itertools.product(*axes):
+            params = dict(zip(grid.keys(), values))
+            result = run_isolated(func, **params)
+            results[case_key(name, params)] = dict(result, case=name, params=params)
+            extra = "".join("  %s=%.4g" % (key, value) for key, value in result.items()
+                            if key not in ["samples_per_sec", "ms_per_batch", "peak_rss_mb", "blas_threads"])
+            print("%-100s %10.1f samples/sec %8.2f ms/batch %8.1f MB peak  blas_threads=%s%s"
+                  % (case_key(name, params), result["samples_per_sec"], result["ms_per_batch"],
+                     result["peak_rss_mb"], result["blas_threads"], extra))
+
+    with open(args.output, 'w') as _file:
+        json.dump(results, _file, indent=2)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as _file:
+            regressions = compare(results, json.load(_file), args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as _file:
+            json.dump(results, _file, indent=2)
+
+    exit(1 if regressions else 0)
@@ -1,6 +1,8 @@
 from util import *
-from rbm import RestrictedBoltzmannMachine
+from rbm import RestrictedBoltzmannMachine, ParallelTempering
 import numpy as np
+import glob
+import os
 from tqdm import tqdm
 
 
@@ -15,113 +17,391 @@ class DeepBeliefNet:
     pen : penultimate
     hid : hidden
     vis : visible
+
+    Any number of hidden layers between "vis" and "pen" is possible (see 'layer_names'). Every pair of neighbouring
+    layers below "pen" is a directed rbm "<lower>--<upper>", the top rbm "pen+lbl--top" is undirected.
     """
 
-    def __init__(self, sizes, image_size, n_labels, batch_size):
+    def __init__(self, sizes, image_size, n_labels, batch_size, dtype=np.float64, seed=None):
 
         """
         Args:
-          sizes: Dictionary of layer names and dimensions
+          sizes: List of layer dimensions from the visible layer to the top layer, without the labels. A dictionary
+          with the keys "vis", "hid", "pen" and "top" is read as the four-layer net
           image_size: Image dimension of data
           n_labels: Number of label categories
           batch_size: Size of mini-batch
-        """
-
-        self.rbm_stack = {
-
-            'vis--hid': RestrictedBoltzmannMachine(ndim_visible=sizes["vis"], ndim_hidden=sizes["hid"],
-                                                   is_bottom=True, image_size=image_size, batch_size=batch_size),
+          dtype: Floating point type of all rbms in the stack, see util.read_mnist to load data of the same type
+          seed: seed of the random streams of the rbms (one independent child stream each, see util.RandomStream).
+          Drawn from the global numpy random state if not given
 
-            'vis--pen': RestrictedBoltzmannMachine(ndim_visible=sizes["vis"], ndim_hidden=sizes["pen"],
-                                                   is_bottom=True, image_size=image_size, batch_size=batch_size),
-
-            'hid--pen': RestrictedBoltzmannMachine(ndim_visible=sizes["hid"], ndim_hidden=sizes["pen"],
-                                                   batch_size=batch_size),
-
-            'pen+lbl--top': RestrictedBoltzmannMachine(ndim_visible=sizes["pen"] + sizes["lbl"],
-                                                       ndim_hidden=sizes["top"],
-                                                       is_top=True, n_labels=n_labels, batch_size=batch_size)
-        }
+        The rbms are only created when they are first used (trained, loaded or run), see '_allocate_rbm'.
+        """
 
-        self.sizes = sizes
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        if isinstance(sizes, dict):
+            sizes = [sizes[name] for name in ["vis", "hid", "pen", "top"]]
+
+        self.layers = layer_names(len(sizes))
+        self.sizes = dict(zip(self.layers, sizes))
+        self.sizes["lbl"] = n_labels
+        self.rbm_names = ["%s--%s" % pair for pair in zip(self.layers[:-2], self.layers[1:-1])] + \
+                         ["%s+lbl--top" % self.layers[-2]]
+        seeds = np.random.SeedSequence(seed).spawn(len(self.rbm_names) + 1)
+        self.seeds = dict(zip(self.rbm_names, seeds))
+        self.rbm_stack = _RbmStack(self._allocate_rbm)
+
+        self.n_labels = n_labels
         self.image_size = image_size
         self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
         self.n_gibbs_recog = 15
         self.n_gibbs_gener = 600
         self.n_gibbs_wakesleep = 15
         self.print_period = 2000
+        self.activation_cache = "activation_cache"  # directory of 'propagate_cached'
+        self.swap_acceptance = None  # swap acceptance rates of the last tempered 'generate_batch'
+        # minibatch order of the wake-sleep fine-tuning, see util.MinibatchSampler and the rbm attributes of that name
+        self.shuffle_seed = int(seeds[-1].generate_state(1)[0])
+        self.shuffle_block_size = None
 
         return
 
-    def recognize(self, true_img, true_lbl):
+    def _allocate_rbm(self, name):
+
+        """New rbm "name" of the stack, called by "rbm_stack" the first time the rbm is looked up"""
+
+        if name not in self.rbm_names:
+            raise KeyError(name)
+        index = self.rbm_names.index(name)
+        is_top = index == len(self.rbm_names) - 1
+
+        ndim_visible = self.sizes[self.layers[index]] + (self.n_labels if is_top else 0)
+
+        return RestrictedBoltzmannMachine(ndim_visible=ndim_visible, ndim_hidden=self.sizes[self.layers[index + 1]],
+                                          is_bottom=index == 0 and not is_top, image_size=self.image_size,
+                                          is_top=is_top, n_labels=self.n_labels, batch_size=self.batch_size,
+                                          dtype=self.dtype, seed=self.seeds[name])
+
+    def _drive_up(self, vis, out=None, sample=False):
+
+        """Drive "vis" bottom-up through the directed rbms with the recognition weights
+
+        Args:
+          vis: visible data shaped (number of samples, size of visible layer)
+          out: optional pair of preallocated arrays for the probabilities and activations of the pen layer, see
+          'RestrictedBoltzmannMachine.get_h_given_v'
+          sample: sample every layer and pass the activations up, instead of the probabilities
+        Returns:
+          tuple ( probabilities, activations ) of the pen layer, activations are None if not sampled
+        """
+
+        directed = self.rbm_names[:-1]
+        if not directed:  # the images are the pen layer
+            vis = to_dense(vis)
+            if out is None:
+                return vis, vis if sample else None
+            out[0][...] = vis
+            if out[1] is not None:
+                out[1][...] = vis
+            return out
+
+        data = self.rbm_stack[directed[0]].prepare_visible(vis)
+        for index, name in enumerate(directed):
+            rbm = self.rbm_stack[name]
+            layer_out = out
+            if layer_out is None or index < len(directed) - 1:
+                layer_out = self._gibbs_buffers(vis.shape[0], rbm.ndim_hidden)
+                if not sample:
+                    layer_out = (layer_out[0], None)
+            probabilities, activations = rbm.get_h_given_v_dir(data, out=layer_out)
+            data = activations if sample else probabilities
+
+        return probabilities, activations
+
+    def _drive_down(self, pen):
+
+        """Visible activations sampled top-down from the pen activations "pen" with the generative weights"""
+
+        data = pen
+        for name in reversed(self.rbm_names[:-1]):
+            data = self.rbm_stack[name].get_v_given_h_dir(data)[1]
+        return data
+
+    def recognize(self, true_img, true_lbl, chunk_size=1000, n_threads=1, mode="sampling", tol=1e-3):
 
         """Recognize/Classify the data into label categories and calculate the accuracy
 
+        The data is processed in chunks of "chunk_size" samples, so memory use depends on the chunk size and not on the
+        number of samples. Chunks can be spread over a pool of "n_threads" threads (numpy releases the GIL in the
+        matrix products).
+
+        In "meanfield" mode the labels come from 'recognize_meanfield' with early exit at "tol", and the histogram of
+        the number of top rbm iterations each sample needed is printed with the accuracy. In "freeenergy" mode they
+        come from 'recognize_free_energy' in a single pass.
+
         Args:
           true_img: visible data shaped (number of samples, size of visible layer)
           true_lbl: true labels shaped (number of samples, size of label layer). Used
           only for calculating accuracy, not driving the net
+          chunk_size: number of samples pushed through the net at once
+          n_threads: number of threads working on chunks
+          mode: "sampling" (stochastic Gibbs chain of "n_gibbs_recog" steps), "meanfield" or "freeenergy"
+          tol: convergence tolerance of the "meanfield" mode
+        Returns:
+          tuple (predicted labels shaped (number of samples,), number of predictions per label category)
         """
 
         n_samples = true_img.shape[0]
-        vis = true_img  # visible layer gets the image data
-        lbl = np.ones(true_lbl.shape) / 10.  # start the net by telling you know nothing about labels
-
-        pen_activation = self.rbm_stack["vis--pen"].get_h_given_v(vis)[1]
+        n_labels = true_lbl.shape[1]
+        predicted_lbl = np.empty(n_samples, dtype=int)
+        iterations = np.empty(n_samples, dtype=int)
+        chunks = [slice(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+
+        def recognize_chunk(chunk):
+            if mode == "meanfield":
+                probabilities, iterations[chunk] = self.recognize_meanfield(true_img[chunk], tol=tol,
+                                                                            return_iterations=True)
+                predicted_lbl[chunk] = np.argmax(probabilities, axis=1)
+            elif mode == "freeenergy":
+                predicted_lbl[chunk] = self.recognize_free_energy(true_img[chunk], return_labels=True)[0]
+            else:
+                predicted_lbl[chunk] = self._recognize_chunk(true_img[chunk], n_labels)
+
+        if n_threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                list(tqdm(pool.map(recognize_chunk, chunks), total=len(chunks)))
+        else:
+            for chunk in tqdm(chunks):
+                recognize_chunk(chunk)
+
+        print("accuracy = %.2f%%" % (100. * np.mean(predicted_lbl == np.argmax(true_lbl, axis=1))))
+        if mode == "meanfield":
+            histogram = np.bincount(iterations)
+            print("iterations histogram (iterations:samples) " + " ".join("%d:%d" % (n_iterations, count) for
+                                                                         n_iterations, count in enumerate(histogram)
+                                                                         if count > 0))
+
+        return predicted_lbl, np.bincount(predicted_lbl, minlength=n_labels)
+
+    def _recognize_chunk(self, vis, n_labels):
+
+        """Drive one chunk of images up to the pen layer, run the recognition Gibbs chain of the top rbm on it and
+        return the predicted label of each"""
+
+        # start the net by telling you know nothing about labels
+        lbl = np.ones((vis.shape[0], n_labels), dtype=self.dtype) / 10.
+
+        pen_activation = self._drive_up(vis, sample=True)[1]
         pen_lbl_activation = np.concatenate((pen_activation, lbl), axis=1)
-        for _ in tqdm(range(self.n_gibbs_recog)):
-            top_activation = self.rbm_stack["pen+lbl--top"].get_h_given_v(pen_lbl_activation)[1]
-            pen_lbl_activation = self.rbm_stack["pen+lbl--top"].get_v_given_h(top_activation)[1]
 
-        predicted_lbl = pen_lbl_activation[:, -true_lbl.shape[1]:]
-        print("accuracy = %.2f%%" % (100. * np.mean(np.argmax(predicted_lbl, axis=1) == np.argmax(true_lbl, axis=1))))
+        # the chain overwrites the same buffers on every step
+        top = self.rbm_stack[self.rbm_names[-1]]
+        top_buffers = self._gibbs_buffers(vis.shape[0], self.sizes["top"])
+        pen_lbl_buffers = (np.empty_like(pen_lbl_activation), pen_lbl_activation)
+        for _ in range(self.n_gibbs_recog):
+            top.get_h_given_v(pen_lbl_activation, out=top_buffers)
+            top.get_v_given_h(top_buffers[1], out=pen_lbl_buffers)
 
-        return
+        return np.argmax(pen_lbl_activation[:, -n_labels:], axis=1)
+
+    def recognize_meanfield(self, vis, n_iterations=None, tol=None, return_iterations=False):
 
-    def generate(self, true_lbl, name):
+        """Label probabilities of "vis" by mean-field recognition, without printing or progress bars
+
+        The images are driven bottom-up with the directed recognition weights, then the top rbm alternates up to
+        "n_iterations" times between its hidden and label probabilities instead of samples. The pen units stay clamped
+        to the pen probabilities of the images, only the labels are updated. The result is deterministic and every row
+        is independent of the other rows in the batch.
+
+        With "tol", a sample is done once its most probable label is the same as in the previous iteration and no
+        label probability moved by more than "tol". Done rows are dropped from the batch, so later iterations only
+        multiply the undecided ones.
+
+        Args:
+          vis: visible data shaped (number of samples, size of visible layer)
+          n_iterations: maximum number of top rbm iterations, "n_gibbs_recog" if not given
+          tol: convergence tolerance, None runs all "n_iterations" for every sample
+          return_iterations: also return the number of iterations each sample ran
+        Returns:
+          label probabilities shaped (number of samples, size of label layer), and if "return_iterations" the
+          iteration counts shaped (number of samples,)
+        """
+
+        if n_iterations is None:
+            n_iterations = self.n_gibbs_recog
+        top = self.rbm_stack[self.rbm_names[-1]]
+        n_samples, n_labels = vis.shape[0], self.sizes["lbl"]
+
+        # start the net by telling you know nothing about labels
+        pen_lbl = np.empty((n_samples, top.ndim_visible), dtype=self.dtype)
+        self._drive_up(vis, out=(pen_lbl[:, :-n_labels], None))
+        pen_lbl[:, -n_labels:] = 1. / n_labels
+
+        # the undecided samples are kept in the first "n_active" rows of the buffers, "active" holds their indices
+        top_p = np.empty((n_samples, self.sizes["top"]), dtype=self.dtype)
+        label_support = np.empty((n_samples, n_labels), dtype=self.dtype)
+        label_weights, label_bias = top.weight_vh[-n_labels:].T, top.bias_v[-n_labels:]
+        previous_lbl = np.empty((n_samples, n_labels), dtype=self.dtype)
+        probabilities = np.empty((n_samples, n_labels), dtype=self.dtype)
+        iterations = np.full(n_samples, n_iterations)
+        active, n_active = np.arange(n_samples), n_samples
+
+        for it in range(n_iterations):
+            if n_active == 0:
+                break
+            rows = slice(0, n_active)
+            previous_lbl[rows] = pen_lbl[rows, -n_labels:]
+            top.get_h_given_v(pen_lbl[rows], out=(top_p[rows], None))
+            # top-down pass to the label units only, the pen units keep the evidence of the images
+            np.matmul(top_p[rows], label_weights, out=label_support[rows])
+            label_support[rows] += label_bias
+            softmax(label_support[rows], out=pen_lbl[rows, -n_labels:])
+
+            if tol is None or it == 0:
+                continue
+            lbl = pen_lbl[rows, -n_labels:]
+            done = (np.argmax(lbl, axis=1) == np.argmax(previous_lbl[rows], axis=1)) & \
+                   (np.max(np.abs(lbl - previous_lbl[rows]), axis=1) <= tol)
+            if not np.any(done):
+                continue
+
+            probabilities[active[done]] = lbl[done]
+            iterations[active[done]] = it + 1
+            keep = ~done
+            active = active[keep]
+            pen_lbl[:len(active)] = pen_lbl[rows][keep]
+            n_active = len(active)
+
+        probabilities[active] = pen_lbl[:n_active, -n_labels:]
+
+        if return_iterations:
+            return probabilities, iterations
+        return probabilities
+
+    def recognize_free_energy(self, vis, return_labels=False):
+
+        """Label probabilities of "vis" from the free energy of the top rbm, without printing or progress bars
+
+        The images are driven bottom-up with the directed recognition weights as in 'recognize_meanfield', then the
+        top rbm scores every label by the free energy of pen+onehot(label) ('classify_free_energy'). This is the exact
+        posterior of the top rbm given the pen probabilities, computed in one pass without Gibbs or mean-field
+        iterations, so it is deterministic and every row is independent of the other rows in the batch.
+
+        Args:
+          vis: visible data shaped (number of samples, size of visible layer)
+          return_labels: also return the most probable label of each sample
+        Returns:
+          label probabilities shaped (number of samples, size of label layer), and if "return_labels" preceded by the
+          labels shaped (number of samples,)
+        """
+
+        labels, probabilities = self.rbm_stack[self.rbm_names[-1]].classify_free_energy(self._drive_up(vis)[0])
+
+        if return_labels:
+            return labels, probabilities
+        return probabilities
+
+    def generate(self, true_lbl, name, n_samples=1, record_period=1, background=False, n_replicas=1, beta_min=0.9):
+
+        """Generate data from labels and save a video per label plus an image grid of the final samples
 
-        """Generate data from labels
         Args:
-          true_lbl: true labels shaped (number of samples, size of label layer)
+          true_lbl: true labels shaped (number of labels, size of label layer)
           name: string used for saving a video of generated visible activations
+          n_samples: number of chains per label, shown side by side in the video
+          record_period: record every "record_period"-th Gibbs step only
+          background: render in a separate process so that this call returns as soon as the sampling is done
+          n_replicas, beta_min: parallel tempering of the top rbm, see 'generate_batch'
+        Returns:
+          generated visible activations, see 'generate_batch'
+        """
+
+        records = self.generate_batch(true_lbl, n_samples=n_samples, record_period=record_period,
+                                      n_replicas=n_replicas, beta_min=beta_min)
+
+        args = (records, self.image_size, "Videos/" + name, np.argmax(true_lbl, axis=1), n_samples)
+        if background:
+            import multiprocessing
+            multiprocessing.get_context("spawn").Process(target=render_generated, args=args).start()
+        else:
+            render_generated(*args)
+
+        return records
+
+    def generate_batch(self, true_lbl, n_samples=1, record_period=1, n_replicas=1, beta_min=0.9):
+
+        """Generate data from labels without any rendering
+
+        All labels times "n_samples" chains run as one batch through the same Gibbs steps. The visible layer is only
+        computed for the recorded steps.
+
+        With "n_replicas" > 1 the top rbm is sampled by parallel tempering (rbm.ParallelTempering) with inverse
+        temperatures spaced geometrically from 1 down to "beta_min", and only the replicas at temperature 1 are
+        recorded. The swap acceptance rates are printed and kept in "swap_acceptance".
+
+        Args:
+          true_lbl: true labels shaped (number of labels, size of label layer)
+          n_samples: number of chains per label
+          record_period: record every "record_period"-th Gibbs step only
+          n_replicas: number of temperatures per chain, 1 is plain Gibbs sampling
+          beta_min: inverse temperature of the hottest replica
+        Returns:
+          visible activations shaped (n_gibbs_gener // record_period, number of labels * n_samples, size of visible
+          layer). Chain i * n_samples + j is sample j of label i
         """
 
-        n_sample = true_lbl.shape[0]
+        lbl = np.repeat(true_lbl.astype(self.dtype, copy=False), n_samples, axis=0)
+        n_chains, n_labels = lbl.shape
 
-        records = []
-        fig, ax = plt.subplots(1, 1, figsize=(3, 3))
-        plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
-        ax.set_xticks([])
-        ax.set_yticks([])
+        records = np.empty((self.n_gibbs_gener // record_period, n_chains, self.sizes['vis']), dtype=self.dtype)
 
-        lbl = true_lbl
-        vis_ = np.random.choice([0, 1], self.sizes['vis']).reshape(-1, self.sizes['vis'])
+        vis_ = np.random.choice([0, 1], (n_chains, self.sizes['vis'])).astype(self.dtype)
 
-        hidden_activation = self.rbm_stack["vis--hid"].get_h_given_v_dir(vis_)[1]
-        pen_activation = self.rbm_stack["hid--pen"].get_h_given_v_dir(hidden_activation)[1]
+        pen_activation = self._drive_up(vis_, sample=True)[1]
         pen_lbl_activation = np.concatenate((pen_activation, lbl), axis=1)
 
-        for _ in tqdm(range(self.n_gibbs_gener)):
-            top_activation = self.rbm_stack["pen+lbl--top"].get_h_given_v(pen_lbl_activation)[1]
-            pen_lbl_activation = self.rbm_stack["pen+lbl--top"].get_v_given_h(top_activation)[1]
-            pen_lbl_activation[:, -lbl.shape[1]:] = lbl[:, :]
-            pen_activation_top_bottom = pen_lbl_activation[:, :-lbl.shape[1]]
-            hidden_activation_top_bottom = self.rbm_stack["hid--pen"].get_v_given_h_dir(pen_activation_top_bottom)[1]
-            vis = self.rbm_stack["vis--hid"].get_v_given_h_dir(hidden_activation_top_bottom)[1]
+        top = self.rbm_stack[self.rbm_names[-1]]
+        sampler = None
+        if n_replicas > 1:
+            sampler = ParallelTempering(top, pen_lbl_activation, n_labels, np.geomspace(1., beta_min, n_replicas))
 
-            records.append([ax.imshow(vis.reshape(self.image_size), cmap="bwr", vmin=0, vmax=1, animated=True,
-                                      interpolation=None)])
+        top_buffers = self._gibbs_buffers(n_chains, self.sizes["top"])
+        pen_lbl_buffers = (np.empty_like(pen_lbl_activation), pen_lbl_activation)
+        for step in tqdm(range(records.shape[0] * record_period)):
+            if sampler is not None:
+                sampler.step()
+            else:
+                top.get_h_given_v(pen_lbl_activation, out=top_buffers)
+                top.get_v_given_h(top_buffers[1], out=pen_lbl_buffers)
+                pen_lbl_activation[:, -n_labels:] = lbl
 
-        stitch_video(fig, records).save("%s.generate%d.mp4" % ("Videos/" + name, np.argmax(true_lbl)))
+            if (step + 1) % record_period == 0:
+                pen_activation_top_bottom = pen_lbl_activation[:, :-n_labels] if sampler is None else sampler.pen
+                records[step // record_period] = self._drive_down(pen_activation_top_bottom)
 
-        return
+        if sampler is not None:
+            self.swap_acceptance = sampler.acceptance_rates()
+            print("swap acceptance rates (beta:rate) %s" % " ".join(
+                "%.3f:%.2f" % pair for pair in zip(sampler.betas[1:], self.swap_acceptance)))
+
+        return records
+
+    def _gibbs_buffers(self, n_chains, ndim):
+
+        """Probability and activation buffers for "n_chains" Gibbs chains in a layer of size "ndim" """
+
+        return np.empty((n_chains, ndim), dtype=self.dtype), np.empty((n_chains, ndim), dtype=self.dtype)
 
     def train_greedylayerwise(self, vis_trainset, lbl_trainset, n_iterations):
 
         """
-        Greedy layer-wise training by stacking RBMs. This method first tries to load previous
-        saved parameters of the entire RBM stack.
-        If not found, learns layer-by-layer (which needs to be completed) .
+        Greedy layer-wise training by stacking RBMs, from the bottom of "rbm_names" up. This method first tries to load
+        previous saved parameters of each RBM in the stack.
+        If not found, learns layer-by-layer from that RBM upwards. The training data of the upper RBMs (the propagated
+        activations of the layers below, and the labels for the top rbm) is cached on disk, see 'propagate_cached'.
         Notice that once you stack more layers on top of a RBM, the weights are permanently untwined.
 
         Args:
@@ -130,129 +410,258 @@ class DeepBeliefNet:
           n_iterations: number of iterations of learning (each iteration learns a mini-batch)
         """
 
-        aux = 0
+        directed = self.rbm_names[:-1]
 
-        try:
+        def trainset(level):
+            """training data of the rbm "level" of the stack, read from the cache once propagated"""
+            data = vis_trainset
+            for index, name in enumerate(directed[:level]):
+                data = self.propagate_cached(name, data, append=lbl_trainset if index == len(directed) - 1 else None)
+            if level == 0 == len(directed):
+                data = np.concatenate((to_dense(data), lbl_trainset), axis=1)
+            return data
 
-            self.loadfromfile_rbm(loc="trained_rbm", name="vis--hid")
-            self.rbm_stack["vis--hid"].untwine_weights()
+        """ 
+        CD-1 training for the directed rbms, vis--hid, hid--pen, ..
+        """
+        retrained = False
+        for level, name in enumerate(directed):
+            retrained, _ = self._load_or_train_rbm(name, lambda: trainset(level), n_iterations, retrain=retrained)
+            self.rbm_stack[name].untwine_weights()
 
-            self.loadfromfile_rbm(loc="trained_rbm", name="hid--pen")
-            self.rbm_stack["hid--pen"].untwine_weights()
+        """ 
+        CD-1 training for pen+lbl--top 
+        """
+        retrained, aux = self._load_or_train_rbm(self.rbm_names[-1], lambda: trainset(len(directed)), n_iterations,
+                                                 retrain=retrained, plotting=True)
 
-            self.loadfromfile_rbm(loc="trained_rbm", name="pen+lbl--top")
+        return aux
 
-        except IOError:
+    def _load_or_train_rbm(self, name, trainset, n_iterations, retrain, plotting=False):
 
-            print("training vis--hid")
-            """ 
-            CD-1 training for vis--hid 
-            """
-            self.rbm_stack["vis--hid"].cd1(vis_trainset, n_iterations)
-            self.savetofile_rbm(loc="trained_rbm", name="vis--hid")
-
-            print("training hid--pen")
-            self.rbm_stack["vis--hid"].untwine_weights()
-            """ 
-            CD-1 training for hid--pen 
-            """
-            h_ = self.rbm_stack["vis--hid"].get_h_given_v_dir(vis_trainset)[1]
-            self.rbm_stack["hid--pen"].cd1(h_, n_iterations)
-            self.savetofile_rbm(loc="trained_rbm", name="hid--pen")
-
-            print("training pen+lbl--top")
-            self.rbm_stack["hid--pen"].untwine_weights()
-            """ 
-            CD-1 training for pen+lbl--top 
-            """
-            h_2 = self.rbm_stack["hid--pen"].get_h_given_v_dir(h_)[1]
-            h_concatenate = np.concatenate((h_2, lbl_trainset), axis=1)
-            aux = self.rbm_stack["pen+lbl--top"].cd1(h_concatenate, n_iterations, plotting=True)
-            self.savetofile_rbm(loc="trained_rbm", name="pen+lbl--top")
+        """
+        Load rbm "name" from 'trained_rbm/'. If that fails, or "retrain" is set because a layer below was just trained,
+        train it with CD-1 on trainset() and save it. An interrupted training run resumes from its checkpoint
+        'trained_rbm/rbm.<name>.ckpt'.
 
-        return aux
+        Returns:
+          tuple (True if the rbm was trained, return value of cd1 or 0)
+        """
 
-    def train_wakesleep_finetune(self, vis_trainset, lbl_trainset, n_iterations):
+        checkpoint = "trained_rbm/rbm.%s.ckpt" % name
+        if not retrain:
+            try:
+                self.loadfromfile_rbm(loc="trained_rbm", name=name)
+                return False, 0
+            except IOError:
+                pass
+        elif os.path.exists(checkpoint):
+            os.remove(checkpoint)  # an unfinished run on the training data of the previous layer below
+
+        print("training %s" % name)
+        aux = self.rbm_stack[name].cd1(trainset(), n_iterations, plotting=plotting, checkpoint=checkpoint)
+        self.savetofile_rbm(loc="trained_rbm", name=name)
+
+        return True, aux
+
+    def propagate_cached(self, name, data, append=None, chunk_size=1000):
+
+        """
+        Sampled activations h ~ p(h|v) of the directed rbm "name" for "data", optionally followed by the columns of
+        "append" (the labels of the top rbm).
+
+        The result is written to a memory-mapped file in "activation_cache", named after a hash of the rbm parameters
+        and of the inputs, and read from there as long as neither changes. Only "chunk_size" rows are in memory at any
+        time while the file is written.
+
+        Returns:
+          read-only memory map shaped (number of samples, size of hidden layer + size of appended data)
+        """
+
+        rbm = self.rbm_stack[name]
+        n_samples = data.shape[0]
+        n_appended = 0 if append is None else append.shape[1]
+
+        key = hash_arrays([rbm.weight_v_to_h, rbm.bias_h, data, append], chunk_size=chunk_size)
+
+        cache_file = os.path.join(self.activation_cache, "%s.%s.npy" % (name, key.hexdigest()))
+        if os.path.exists(cache_file):
+            print("loaded activations of rbm[%s] from %s" % (name, cache_file))
+            return np.load(cache_file, mmap_mode='r')
+
+        os.makedirs(self.activation_cache, exist_ok=True)
+        for stale_file in glob.glob(os.path.join(self.activation_cache, "%s.*.npy" % glob.escape(name))):
+            os.remove(stale_file)
+
+        activations = np.lib.format.open_memmap(cache_file + ".tmp", mode='w+', dtype=rbm.dtype,
+                                                shape=(n_samples, rbm.ndim_hidden + n_appended))
+        for start in range(0, n_samples, chunk_size):
+            chunk = slice(start, min(start + chunk_size, n_samples))
+            activations[chunk, :rbm.ndim_hidden] = rbm.get_h_given_v_dir(rbm.prepare_visible(data[chunk]))[1]
+            if append is not None:
+                activations[chunk, rbm.ndim_hidden:] = append[chunk]
+        activations.flush()
+        del activations
+        os.replace(cache_file + ".tmp", cache_file)
+
+        return np.load(cache_file, mmap_mode='r')
+
+    def train_wakesleep_finetune(self, vis_trainset, lbl_trainset, n_iterations,
+                                 checkpoint="trained_dbn/wakesleep.ckpt", checkpoint_period=1000):
 
         """
         Wake-sleep method for learning all the parameters of network. 
         First tries to load previous saved parameters of the entire network.
+        Every minibatch is one '_wakesleep_step' in buffers that are allocated once. Every epoch visits the training
+        set in a new order drawn from "shuffle_seed", see util.MinibatchSampler.
         Args:
           vis_trainset: visible data shaped (size of training set, size of visible layer)
           lbl_trainset: label data shaped (size of training set, size of label layer)
           n_iterations: number of iterations of learning (each iteration learns a mini-batch)
+          checkpoint: file name of a checkpoint of the whole network written every "checkpoint_period" minibatches.
+          If it exists, training resumes from the minibatch after the checkpoint. Removed once training is complete.
+          None disables checkpoints.
+          checkpoint_period: number of minibatches between checkpoints, counted over all epochs
         """
 
         print("\ntraining wake-sleep..")
 
         try:
 
-            self.loadfromfile_dbn(loc="trained_dbn", name="vis--hid")
-            self.loadfromfile_dbn(loc="trained_dbn", name="hid--pen")
-            self.loadfromfile_rbm(loc="trained_dbn", name="pen+lbl--top")
+            self.loadfromfile_stack(loc="trained_dbn")
 
         except IOError:
 
+            start_epoch, start_it = 0, 0
+            if checkpoint is not None and os.path.exists(checkpoint):
+                start_epoch, start_it = self.loadfromfile_checkpoint(checkpoint)
+                print("resuming from %s at epoch %d, iteration %d" % (checkpoint, start_epoch, start_it))
+
             self.n_samples = vis_trainset.shape[0]
             n_labels = lbl_trainset.shape[1]
-            elements = int(self.n_samples / self.batch_size)
+            sampler = MinibatchSampler([vis_trainset, lbl_trainset], self.batch_size, seed=self.shuffle_seed,
+                                       block_size=self.shuffle_block_size)
+            elements = len(sampler)
 
-            for epoch in range(n_iterations):
-                for it in tqdm(range(elements)):
+            buffers = self._allocate_wakesleep_buffers(n_labels)
 
-                    index_init = int(it % elements)
-                    index_stop = int((index_init + 1) * self.batch_size)
-                    index_init *= self.batch_size
-                    vis_minibatch = vis_trainset[index_init:index_stop, :]
-                    lbl_minibatch = lbl_trainset[index_init:index_stop, :]
+            for epoch in range(start_epoch, n_iterations):
+                for rbm in self.rbm_stack.values():
+                    rbm.epoch = epoch
+                start = start_it if epoch == start_epoch else 0
+                for it, (vis_minibatch, lbl_minibatch) in enumerate(tqdm(sampler.epoch(epoch, start),
+                                                                         total=elements - start), start):
 
-                    # [TODO TASK 4.3] wake-phase : drive the network bottom to top using fixing the visible and label data.
-                    p_hid_wake, lbl_hid_wake = self.rbm_stack['vis--hid'].get_h_given_v_dir(vis_minibatch)
-                    p_pen_wake, lbl_pen_wake = self.rbm_stack['hid--pen'].get_h_given_v_dir(lbl_hid_wake)
-                    lbl_pen = np.concatenate((lbl_pen_wake, lbl_minibatch), axis=1)
-                    p_wake, lbl_wake = self.rbm_stack['pen+lbl--top'].get_h_given_v(lbl_pen)
+                    self._wakesleep_step(vis_minibatch, lbl_minibatch, buffers)
 
-                    lbl_pen_0 = np.copy(lbl_pen)
+                    # counted over all epochs, an epoch may be shorter than the period
+                    if checkpoint is not None and (epoch * elements + it + 1) % checkpoint_period == 0:
+                        self.savetofile_checkpoint(checkpoint, epoch, it + 1)
 
+            self.savetofile_stack(loc="trained_dbn")
 
-                    # GIBBS AT TOP
-                    lbl_neg = lbl_wake
-                    lbl_pen_neg = 0
-                    for _ in range(self.n_gibbs_wakesleep):
-                        p_pen_neg, lbl_pen_neg = self.rbm_stack['pen+lbl--top'].get_v_given_h(lbl_neg)
-                        p_neg, lbl_neg = self.rbm_stack['pen+lbl--top'].get_h_given_v(lbl_pen_neg)
+            if checkpoint is not None and os.path.exists(checkpoint):
+                os.remove(checkpoint)
 
-                    # [TODO TASK 4.3] sleep phase : from the activities in the top RBM, drive the network top to bottom.
-                    lbl_pen_sleep = lbl_pen_neg[:, :-n_labels]
-                    p_pen_sleep = p_pen_neg[:, :-n_labels]
-                    p_hid_sleep, lbl_hid_sleep = self.rbm_stack['hid--pen'].get_v_given_h_dir(lbl_pen_sleep)
-                    p_vis_sleep, lbl_vis_sleep = self.rbm_stack['vis--hid'].get_v_given_h_dir(lbl_hid_sleep)
+        return
 
-                    pred_p_pen_sleep, pred_lbl_pen_sleep = self.rbm_stack['hid--pen'].get_h_given_v_dir(lbl_hid_sleep)
-                    pred_p_hid_sleep, pred_lbl_hid_sleep = self.rbm_stack['vis--hid'].get_h_given_v_dir(lbl_vis_sleep)
-                    pred_p_vis, pred_lbl_vis = self.rbm_stack['vis--hid'].get_v_given_h_dir(lbl_hid_wake)
-                    pred_p_hid, pred_lbl_hid = self.rbm_stack['hid--pen'].get_v_given_h_dir(lbl_pen_wake)
+    def _allocate_wakesleep_buffers(self, n_labels):
+
+        """Buffers of '_wakesleep_step': a (probabilities, activations) pair per layer and phase, shaped
+        (batch_size, size of layer). The per-layer lists hold the layers below pen ("wake" and "pred_sleep" start one
+        layer above the images, "sleep" and "pred_wake" at the images); the pen activations of the wake phase are
+        written into "pen_lbl_wake". The rbms get their workspaces, so that their updates run in place as well."""
+
+        batch = self.batch_size
+        sizes = [self.sizes[name] for name in self.layers]
+        n_directed = len(self.rbm_names) - 1
+        for name in self.rbm_names:
+            self.rbm_stack[name].allocate_workspace()
+
+        return {
+            "wake": [self._gibbs_buffers(batch, size) for size in sizes[1:n_directed]],
+            "pen_lbl_wake": self._gibbs_buffers(batch, sizes[-2] + n_labels),
+            "top_wake": self._gibbs_buffers(batch, sizes[-1]),
+            "pen_lbl_neg": self._gibbs_buffers(batch, sizes[-2] + n_labels),
+            "top_neg": self._gibbs_buffers(batch, sizes[-1]),
+            "sleep": [self._gibbs_buffers(batch, size) for size in sizes[:n_directed]],
+            "pred_sleep": [self._gibbs_buffers(batch, size) for size in sizes[1:n_directed + 1]],
+            "pred_wake": [self._gibbs_buffers(batch, size) for size in sizes[:n_directed]],
+        }
 
-                    self.rbm_stack['vis--hid'].update_generate_params(lbl_hid_wake, vis_minibatch, pred_p_vis)
-                    self.rbm_stack['hid--pen'].update_generate_params(lbl_pen_wake, p_hid_wake, pred_p_hid)
+    def _wakesleep_step(self, vis_minibatch, lbl_minibatch, buffers):
 
-                    lbl_pen = np.concatenate((lbl_pen_wake, lbl_minibatch), axis=1)
-                    self.rbm_stack['pen+lbl--top'].update_params(lbl_pen_0, lbl_wake, p_pen_neg, p_neg)
+        """One wake-sleep update on a minibatch, every intermediate result written into "buffers"
+        (see '_allocate_wakesleep_buffers').
 
-                    self.rbm_stack['hid--pen'].update_recognize_params(lbl_hid_sleep, lbl_pen_sleep, pred_lbl_pen_sleep)
-                    self.rbm_stack['vis--hid'].update_recognize_params(p_vis_sleep, lbl_hid_sleep, pred_lbl_hid_sleep)
+        Each quantity is computed once, and activations are only sampled where the updates or the next pass use
+        them: the generative predictions of the wake phase and the last top hidden layer of the Gibbs chain stay
+        probabilities. All predictions are computed before the first parameter changes. A minibatch of fewer than
+        batch_size samples (the last of an epoch) uses the first rows of the buffers.
+        """
 
-            self.savetofile_dbn(loc="trained_dbn", name="vis--hid")
-            self.savetofile_dbn(loc="trained_dbn", name="hid--pen")
-            self.savetofile_rbm(loc="trained_dbn", name="pen+lbl--top")
+        if vis_minibatch.shape[0] != self.batch_size:
+            buffers = _first_rows(buffers, vis_minibatch.shape[0])
+
+        directed = [self.rbm_stack[name] for name in self.rbm_names[:-1]]
+        top = self.rbm_stack[self.rbm_names[-1]]
+        n_directed, n_labels = len(directed), lbl_minibatch.shape[1]
+
+        # [TODO TASK 4.3] wake-phase : drive the network bottom to top using fixing the visible and label data.
+        # the pen activations are sampled straight into the pen part of the top rbm's visible layer.
+        # p_wake[i], wake[i] are the probabilities and activations of layer i, the images at 0
+        p_pen_lbl_wake, pen_lbl_wake = buffers["pen_lbl_wake"]
+        p_wake, wake = [vis_minibatch], [vis_minibatch]
+        for index, rbm in enumerate(directed):
+            out = buffers["wake"][index] if index < n_directed - 1 else (p_pen_lbl_wake[:, :-n_labels],
+                                                                         pen_lbl_wake[:, :-n_labels])
+            probabilities, activations = rbm.get_h_given_v_dir(wake[index], out=out)
+            p_wake.append(probabilities)
+            wake.append(activations)
+        if not directed:
+            pen_lbl_wake[:, :-n_labels] = vis_minibatch
+        pen_lbl_wake[:, -n_labels:] = lbl_minibatch
+        top_wake = top.get_h_given_v(pen_lbl_wake, out=buffers["top_wake"])[1]
+
+        # GIBBS AT TOP
+        top_neg = top_wake
+        p_top_neg = buffers["top_neg"][0]
+        for step in range(self.n_gibbs_wakesleep):
+            p_pen_lbl_neg, pen_lbl_neg = top.get_v_given_h(top_neg, out=buffers["pen_lbl_neg"])
+            last = step == self.n_gibbs_wakesleep - 1
+            top_neg = top.get_h_given_v(pen_lbl_neg, out=(p_top_neg, None if last else buffers["top_neg"][1]))[1]
+
+        # [TODO TASK 4.3] sleep phase : from the activities in the top RBM, drive the network top to bottom.
+        # p_sleep[i], sleep[i] are the probabilities and activations of layer i, the pen layer at n_directed
+        p_sleep, sleep = [None] * (n_directed + 1), [None] * n_directed + [pen_lbl_neg[:, :-n_labels]]
+        for index in reversed(range(n_directed)):
+            p_sleep[index], sleep[index] = directed[index].get_v_given_h_dir(sleep[index + 1],
+                                                                             out=buffers["sleep"][index])
+
+        # predictions
+        pred_sleep = [None] * n_directed
+        for index in reversed(range(n_directed)):
+            pred_sleep[index] = directed[index].get_h_given_v_dir(sleep[index], out=buffers["pred_sleep"][index])[1]
+        pred_p_wake = [rbm.get_v_given_h_dir(wake[index + 1], out=(buffers["pred_wake"][index][0], None))[0]
+                       for index, rbm in enumerate(directed)]
+
+        # updates : generative, top rbm, recognition. The recognition weights of the bottom rbm learn from the
+        # probabilities of the dreamt images, the others from the activations
+        for index, rbm in enumerate(directed):
+            rbm.update_generate_params(wake[index + 1], p_wake[index], pred_p_wake[index])
+        top.update_params(pen_lbl_wake, top_wake, p_pen_lbl_neg, p_top_neg)
+        for index in reversed(range(n_directed)):
+            directed[index].update_recognize_params(p_sleep[index] if index == 0 else sleep[index], sleep[index + 1],
+                                                    pred_sleep[index])
 
         return
 
     def loadfromfile_rbm(self, loc, name):
 
-        self.rbm_stack[name].weight_vh = np.load("%s/rbm.%s.weight_vh.npy" % (loc, name))
-        self.rbm_stack[name].bias_v = np.load("%s/rbm.%s.bias_v.npy" % (loc, name))
-        self.rbm_stack[name].bias_h = np.load("%s/rbm.%s.bias_h.npy" % (loc, name))
+        dtype = self.rbm_stack[name].dtype
+        self.rbm_stack[name].weight_vh = np.load("%s/rbm.%s.weight_vh.npy" % (loc, name)).astype(dtype, copy=False)
+        self.rbm_stack[name].bias_v = np.load("%s/rbm.%s.bias_v.npy" % (loc, name)).astype(dtype, copy=False)
+        self.rbm_stack[name].bias_h = np.load("%s/rbm.%s.bias_h.npy" % (loc, name)).astype(dtype, copy=False)
         print("loaded rbm[%s] from %s" % (name, loc))
         return
 
@@ -265,10 +674,13 @@ class DeepBeliefNet:
 
     def loadfromfile_dbn(self, loc, name):
 
-        self.rbm_stack[name].weight_v_to_h = np.load("%s/dbn.%s.weight_v_to_h.npy" % (loc, name))
-        self.rbm_stack[name].weight_h_to_v = np.load("%s/dbn.%s.weight_h_to_v.npy" % (loc, name))
-        self.rbm_stack[name].bias_v = np.load("%s/dbn.%s.bias_v.npy" % (loc, name))
-        self.rbm_stack[name].bias_h = np.load("%s/dbn.%s.bias_h.npy" % (loc, name))
+        dtype = self.rbm_stack[name].dtype
+        self.rbm_stack[name].weight_v_to_h = np.load("%s/dbn.%s.weight_v_to_h.npy" % (loc, name)).astype(dtype,
+                                                                                                       copy=False)
+        self.rbm_stack[name].weight_h_to_v = np.load("%s/dbn.%s.weight_h_to_v.npy" % (loc, name)).astype(dtype,
+                                                                                                       copy=False)
+        self.rbm_stack[name].bias_v = np.load("%s/dbn.%s.bias_v.npy" % (loc, name)).astype(dtype, copy=False)
+        self.rbm_stack[name].bias_h = np.load("%s/dbn.%s.bias_h.npy" % (loc, name)).astype(dtype, copy=False)
         print("loaded rbm[%s] from %s" % (name, loc))
         return
 
@@ -279,3 +691,91 @@ class DeepBeliefNet:
         np.save("%s/dbn.%s.bias_v" % (loc, name), self.rbm_stack[name].bias_v)
         np.save("%s/dbn.%s.bias_h" % (loc, name), self.rbm_stack[name].bias_h)
         return
+
+    def loadfromfile_stack(self, loc):
+
+        """Load the whole stack saved by 'savetofile_stack': the directed rbms with 'loadfromfile_dbn' and the top rbm
+        with 'loadfromfile_rbm'"""
+
+        for name in self.rbm_names[:-1]:
+            self.loadfromfile_dbn(loc=loc, name=name)
+        self.loadfromfile_rbm(loc=loc, name=self.rbm_names[-1])
+        return
+
+    def savetofile_stack(self, loc):
+
+        for name in self.rbm_names[:-1]:
+            self.savetofile_dbn(loc=loc, name=name)
+        self.savetofile_rbm(loc=loc, name=self.rbm_names[-1])
+        return
+
+    def savetofile_checkpoint(self, filename, epoch=0, iteration=0):
+
+        """Write all rbms of the stack, the random states and the training position to a single checkpoint file
+        (see util.save_checkpoint)"""
+
+        arrays, random_state = get_random_state()
+        for name, rbm in self.rbm_stack.items():
+            for key, value in rbm.get_state().items():
+                arrays["%s.%s" % (name, key)] = value
+        save_checkpoint(filename, arrays, {"epoch": epoch, "iteration": iteration, "batch_size": self.batch_size,
+                                           "random_state": random_state, "shuffle_seed": self.shuffle_seed,
+                                           "random_streams": {name: rbm.random.state
+                                                              for name, rbm in self.rbm_stack.items()}})
+        return
+
+    def loadfromfile_checkpoint(self, filename):
+
+        """Restore the state written by 'savetofile_checkpoint' and return the (epoch, iteration) to resume from"""
+
+        arrays, meta = load_checkpoint(filename)
+        if meta["batch_size"] != self.batch_size or not set(meta["random_streams"]) <= set(self.rbm_names):
+            raise ValueError("checkpoint %s does not match this network" % filename)
+
+        for name in meta["random_streams"]:
+            rbm, prefix = self.rbm_stack[name], name + "."
+            rbm.set_state({key[len(prefix):]: value for key, value in arrays.items() if key.startswith(prefix)})
+            rbm.random.state = meta["random_streams"][name]
+        set_random_state(arrays, meta["random_state"])
+        self.shuffle_seed = meta.get("shuffle_seed", self.shuffle_seed)
+        print("loaded dbn from %s" % filename)
+        return meta["epoch"], meta["iteration"]
+
+
+def layer_names(n_layers):
+    """
+    Names of the layers of a DeepBeliefNet with "n_layers" layers, bottom to top: "vis", the hidden layers ("hid", or
+    "hid1", "hid2", .. if there are several), "pen" and "top". Four layers are "vis", "hid", "pen" and "top"
+    """
+    if n_layers < 2:
+        raise ValueError("a deep belief net needs at least a visible and a top layer, not %d layers" % n_layers)
+
+    n_hidden = n_layers - 3
+    hidden = ["hid"] if n_hidden == 1 else ["hid%d" % (index + 1) for index in range(n_hidden)]
+    return ["vis"] + hidden + (["pen"] if n_layers > 2 else []) + ["top"]
+
+
+class _RbmStack(dict):
+    """
+    The "rbm_stack" of a DeepBeliefNet: a dictionary of rbms by name that creates an rbm with allocate(name) the first
+    time it is looked up, so only the rbms in use take memory
+    """
+
+    def __init__(self, allocate):
+        super().__init__()
+        self.allocate = allocate
+
+    def __missing__(self, name):
+        self[name] = self.allocate(name)
+        return self[name]
+
+
+def _first_rows(buffers, n_rows):
+    """
+    "buffers" (dicts, lists and tuples of arrays) with every array cut to its first "n_rows" rows, as views
+    """
+    if isinstance(buffers, dict):
+        return {key: _first_rows(value, n_rows) for key, value in buffers.items()}
+    if isinstance(buffers, (list, tuple)):
+        return type(buffers)(_first_rows(value, n_rows) for value in buffers)
+    return buffers[:n_rows]
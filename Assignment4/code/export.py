@@ -0,0 +1,228 @@
+"""
+Recognition-only export of a trained DeepBeliefNet, with compressed weights.
+
+ > python export.py                                     int8 export of trained_dbn/ as trained_dbn/recognizer.npz
+ > python export.py --precision float16                 float16 weights
+ > python export.py --precision int8 --rank 100         rank-100 factors of every weight matrix, stored as int8
+ > python export.py --synthetic                         report on synthetic MNIST-like test images instead of MNIST
+
+Only what recognition uses is written: the directed recognition weights "weight_v_to_h" and hidden biases of the
+lower layers, and the weights, hidden bias and label biases of the top rbm. Generative weights and visible biases are
+dropped. Weight matrices are stored as float32, float16 or int8 with one float32 scale per column (and optionally as
+two low-rank factors, each stored that way); biases stay float32.
+
+CompressedRecognizer loads an export, expands the weights to float32 once and classifies with the bottom-up pass and
+the free-energy label posterior of DeepBeliefNet.recognize_free_energy. After exporting, the model size, the accuracy
+delta on the test images and the images/sec of both models are printed.
+"""
+from util import *
+from dbn import DeepBeliefNet
+import argparse
+import json
+import os
+import time
+
+PRECISIONS = ["float32", "float16", "int8"]
+
+
+def compress_weight(weight, precision="int8", rank=None):
+    """
+    Compressed arrays of the matrix "weight" as a list of factors, each a dict of arrays to store.
+
+    With "rank", weight ~ U @ V from the truncated SVD, U = u[:, :rank] * s[:rank] and V = vt[:rank]. Each factor is
+    stored in "precision": float32, float16, or int8 values "q" with a float32 "scale" per column (factor ~ q * scale).
+    """
+    weight = np.asarray(weight, dtype=np.float32)
+    factors = [weight]
+    if rank is not None and rank < min(weight.shape):
+        u, s, vt = np.linalg.svd(weight, full_matrices=False)
+        factors = [u[:, :rank] * s[:rank], vt[:rank]]
+
+    compressed = []
+    for factor in factors:
+        if precision == "int8":
+            scale = np.max(np.abs(factor), axis=0) / 127.
+            scale[scale == 0.] = 1.
+            compressed.append({"q": np.round(factor / scale).astype(np.int8), "scale": scale.astype(np.float32)})
+        else:
+            compressed.append({"q": factor.astype(precision)})
+    return compressed
+
+
+def expand_weight(factors):
+    """
+    float32 factors of a matrix compressed by 'compress_weight', to be multiplied in order
+    """
+    expanded = []
+    for factor in factors:
+        q = factor["q"].astype(np.float32)
+        if "scale" in factor:
+            q *= factor["scale"]
+        expanded.append(q)
+    return expanded
+
+
+def export_recognizer(dbn, filename, precision="int8", rank=None):
+    """
+    Write the recognition-only model of "dbn" to the .npz file "filename", see the module documentation
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be one of %s, not %r" % (PRECISIONS, precision))
+
+    arrays = {}
+
+    def add_weight(prefix, weight):
+        for index, factor in enumerate(compress_weight(weight, precision, rank)):
+            for key, value in factor.items():
+                arrays["%s.%d.%s" % (prefix, index, key)] = value
+
+    directed = dbn.rbm_names[:-1]
+    for index, name in enumerate(directed):
+        rbm = dbn.rbm_stack[name]
+        add_weight("layer%d.weight" % index, rbm.weight_v_to_h)
+        arrays["layer%d.bias" % index] = rbm.bias_h.astype(np.float32)
+
+    top = dbn.rbm_stack[dbn.rbm_names[-1]]
+    n_data = top.ndim_visible - top.n_labels
+    add_weight("top.weight", top.weight_vh[:n_data])
+    arrays["top.bias"] = top.bias_h.astype(np.float32)
+    arrays["top.label_weight"] = top.weight_vh[n_data:].astype(np.float32)
+    arrays["top.label_bias"] = top.bias_v[n_data:].astype(np.float32)
+
+    arrays["meta"] = np.array(json.dumps({"precision": precision, "rank": rank, "n_layers": len(directed),
+                                          "ndim_visible": dbn.sizes["vis"], "n_labels": top.n_labels}))
+
+    with open(filename + ".tmp", 'wb') as _file:
+        np.savez(_file, **arrays)
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+
+class CompressedRecognizer:
+    """
+    Classifier loaded from an 'export_recognizer' file. Weights are expanded to float32 once at load time
+    """
+
+    def __init__(self, filename):
+
+        with np.load(filename) as arrays:
+            self.meta = json.loads(str(arrays["meta"]))
+
+            def weight(prefix):
+                factors, index = [], 0
+                while "%s.%d.q" % (prefix, index) in arrays:
+                    factor = "%s.%d." % (prefix, index)
+                    factors.append({key[len(factor):]: arrays[key] for key in arrays.files if key.startswith(factor)})
+                    index += 1
+                return expand_weight(factors)
+
+            self.layers = [(weight("layer%d.weight" % index), arrays["layer%d.bias" % index])
+                           for index in range(self.meta["n_layers"])]
+            self.top = (weight("top.weight"), arrays["top.bias"])
+            self.label_weight = arrays["top.label_weight"]
+            self.label_bias = arrays["top.label_bias"]
+
+        self.dtype = np.dtype(np.float32)
+
+    def recognize(self, vis, return_labels=False):
+
+        """Label probabilities of "vis", as DeepBeliefNet.recognize_free_energy
+
+        Args:
+          vis: visible data shaped (number of samples, size of visible layer)
+          return_labels: also return the most probable label of each sample
+        Returns:
+          label probabilities shaped (number of samples, number of labels), and if "return_labels" preceded by the
+          labels shaped (number of samples,)
+        """
+
+        activations = np.asarray(vis, dtype=self.dtype)
+        for factors, bias in self.layers:
+            activations = self._affine(activations, factors, bias)
+            sigmoid(activations, out=activations)
+        labels, probabilities = label_posterior(self._affine(activations, *self.top), self.label_weight,
+                                                self.label_bias)
+
+        if return_labels:
+            return labels, probabilities
+        return probabilities
+
+    @staticmethod
+    def _affine(inputs, factors, bias):
+        for factor in factors:
+            inputs = inputs @ factor
+        inputs += bias
+        return inputs
+
+
+def model_bytes(dbn):
+    """
+    Bytes of all parameter arrays of "dbn", generative ones included
+    """
+    total = 0
+    for rbm in dbn.rbm_stack.values():
+        for key in ["weight_vh", "weight_v_to_h", "weight_h_to_v", "bias_v", "bias_h"]:
+            value = getattr(rbm, key)
+            if isinstance(value, np.ndarray):
+                total += value.nbytes
+    return total
+
+
+def compare(dbn, filename, images, labels, chunk_size=1000):
+    """
+    Model size, test accuracy and images/sec of the full "dbn" (DeepBeliefNet.recognize_free_energy) and of its export
+    in "filename", both classifying "images" in chunks of "chunk_size", and the fraction of images both give the same
+    label. Prints a report and returns it as a dict
+    """
+    recognizer = CompressedRecognizer(filename)
+    true_lbl = np.argmax(labels, axis=1)
+    chunks = [slice(start, start + chunk_size) for start in range(0, images.shape[0], chunk_size)]
+
+    def run(recognize):
+        start = time.perf_counter()
+        predicted = np.concatenate([recognize(images[chunk], return_labels=True)[0] for chunk in chunks])
+        return predicted, images.shape[0] / (time.perf_counter() - start)
+
+    full_predicted, full_speed = run(dbn.recognize_free_energy)
+    predicted, speed = run(recognizer.recognize)
+    full_accuracy, accuracy = float(np.mean(full_predicted == true_lbl)), float(np.mean(predicted == true_lbl))
+    report = {"full_bytes": model_bytes(dbn), "export_bytes": os.path.getsize(filename),
+              "full_accuracy": full_accuracy, "export_accuracy": accuracy,
+              "agreement": float(np.mean(predicted == full_predicted)),
+              "full_images_per_sec": full_speed, "export_images_per_sec": speed}
+
+    print("%s (%s, rank %s)" % (filename, recognizer.meta["precision"], recognizer.meta["rank"]))
+    print("  size        %8.2f MB -> %8.2f MB  (%.1fx smaller)" % (report["full_bytes"] / 2 ** 20,
+                                                                   report["export_bytes"] / 2 ** 20,
+                                                                   report["full_bytes"] / report["export_bytes"]))
+    print("  accuracy    %8.2f%%  -> %8.2f%%   (delta %+.2f points)" % (100. * full_accuracy, 100. * accuracy,
+                                                                        100. * (accuracy - full_accuracy)))
+    print("  same label as the full net for %.2f%% of the images" % (100. * report["agreement"]))
+    print("  images/sec  %8.0f    -> %8.0f     (%.2fx)" % (full_speed, speed, speed / full_speed))
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loc", default="trained_dbn", help="directory of the trained network")
+    parser.add_argument("--output", default=None, help="export file (default: <loc>/recognizer.npz)")
+    parser.add_argument("--precision", choices=PRECISIONS, default="int8")
+    parser.add_argument("--rank", type=int, default=None, help="store every weight matrix as two rank-RANK factors")
+    parser.add_argument("--n-test", type=int, default=10000, help="number of test images of the report")
+    parser.add_argument("--synthetic", action="store_true",
+                        help="random MNIST-like test images instead of MNIST, only the accuracy delta is meaningful")
+    args = parser.parse_args()
+
+    from serve import load_dbn
+    dbn = load_dbn(args.loc)
+    output = args.output or os.path.join(args.loc, "recognizer.npz")
+    export_recognizer(dbn, output, precision=args.precision, rank=args.rank)
+
+    if args.synthetic:
+        from benchmark import synthetic_mnist
+        test_imgs, test_lbls = synthetic_mnist(args.n_test)
+    else:
+        test_imgs, test_lbls = read_mnist(dim=[28, 28], n_train=0, n_test=args.n_test, cache_dir="mnist_cache")[2:]
+
+    compare(dbn, output, test_imgs, test_lbls)
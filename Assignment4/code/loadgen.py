@@ -0,0 +1,97 @@
+"""
+Load generator for serve.py: p50/p99 request latency and throughput for a range of micro-batch windows.
+
+ > python loadgen.py                                   start a server per window on trained_dbn/ and measure
+ > python loadgen.py --windows 0 1 5 20 --clients 32   windows in ms, 32 concurrent clients
+ > python loadgen.py --random-weights                  untrained net of the default size (no trained_dbn/ needed)
+ > python loadgen.py --url http://127.0.0.1:8000       measure a running server instead (its window is fixed)
+
+Every client sends its requests one after the other, so "clients" is the number of requests in flight. Latencies are
+measured by the clients and include HTTP and JSON overhead. Images are synthetic MNIST-like data.
+"""
+from util import *
+from dbn import DeepBeliefNet
+from serve import load_dbn, make_server
+from benchmark import synthetic_mnist, dbn_sizes, IMAGE_SIZE
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import threading
+import time
+import urllib.request
+
+
+def post(url, images):
+    request = urllib.request.Request(url + "/predict", data=json.dumps({"images": images.tolist()}).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run_load(url, images, n_clients, n_requests, images_per_request):
+    """
+    "n_clients" threads each send "n_requests" requests of "images_per_request" images. Returns client side latency
+    percentiles in ms and requests per second, plus the server's own /stats
+    """
+    def client(client_id):
+        rng = np.random.default_rng(client_id)
+        latencies = []
+        for _ in range(n_requests):
+            rows = rng.integers(0, images.shape[0], images_per_request)
+            start = time.perf_counter()
+            post(url, images[rows])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as pool:
+        latencies = np.concatenate(list(pool.map(client, range(n_clients)))) * 1000.
+    elapsed = time.perf_counter() - start
+
+    with urllib.request.urlopen(url + "/stats") as response:
+        server_stats = json.loads(response.read())
+
+    return {"p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99)),
+            "requests_per_sec": len(latencies) / elapsed, "server": server_stats}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="measure this running server instead of starting one per window")
+    parser.add_argument("--loc", default="trained_dbn", help="directory of the trained network")
+    parser.add_argument("--random-weights", action="store_true", help="serve an untrained net of the default size")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0., 1., 5., 20.], help="max wait values in ms")
+    parser.add_argument("--max-batch", type=int, default=64, help="largest micro-batch, in images")
+    parser.add_argument("--clients", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=50, help="requests per client")
+    parser.add_argument("--images", type=int, default=1, help="images per request")
+    args = parser.parse_args()
+
+    images, _ = synthetic_mnist(1000)
+
+    if args.url:
+        results = [(None, run_load(args.url, images, args.clients, args.requests, args.images))]
+    else:
+        if args.random_weights:
+            dbn = DeepBeliefNet(sizes=dbn_sizes(500), image_size=IMAGE_SIZE, n_labels=10, batch_size=1)
+            for name in ["vis--hid", "hid--pen"]:
+                dbn.rbm_stack[name].untwine_weights()
+        else:
+            dbn = load_dbn(args.loc)
+
+        results = []
+        for window in args.windows:
+            server = make_server(dbn, port=0, max_batch=args.max_batch, max_wait=window / 1000.)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            url = "http://%s:%d" % server.server_address
+            results.append((window, run_load(url, images, args.clients, args.requests, args.images)))
+            server.shutdown()
+            server.server_close()
+
+    print("%10s %10s %10s %12s %12s" % ("window_ms", "p50_ms", "p99_ms", "requests/s", "batch_images"))
+    for window, result in results:
+        print("%10s %10.2f %10.2f %12.1f %12.2f" % ("-" if window is None else "%g" % window, result["p50_ms"],
+                                                    result["p99_ms"], result["requests_per_sec"],
+                                                    result["server"]["mean_batch_images"]))
@@ -1,5 +1,14 @@
 from util import *
 from tqdm import tqdm
+import os
+
+# attributes written to checkpoints, see 'get_state'
+STATE_ARRAYS = ["weight_vh", "weight_v_to_h", "weight_h_to_v", "bias_v", "bias_h",
+                "delta_weight_vh", "delta_weight_v_to_h", "delta_weight_h_to_v", "delta_bias_v", "delta_bias_h",
+                "fantasy_hidden"]
+
+# workspace buffers with one row per sample of the minibatch, see 'batch_workspace'
+MINIBATCH_BUFFERS = ["p_h_0", "h_0", "p_v_1", "v_1", "p_h_1", "h_1", "diff_v", "diff_h"]
 
 
 class RestrictedBoltzmannMachine:
@@ -9,7 +18,7 @@ class RestrictedBoltzmannMachine:
     """
 
     def __init__(self, ndim_visible, ndim_hidden, is_bottom=False, image_size=None, is_top=False, n_labels=10,
-                 batch_size=10):
+                 batch_size=10, dtype=np.float64, seed=None):
 
         """
         Args:
@@ -22,6 +31,9 @@ class RestrictedBoltzmannMachine:
           concatenated with "n_label" unit of label data at the end.
           n_labels: Number of label categories.
           batch_size: Size of mini-batch.
+          dtype: Floating point type of parameters and activations. Inputs should have the same type.
+          seed: seed (int or np.random.SeedSequence) of the random stream all sampling of this rbm draws from, see
+          util.RandomStream. Drawn from the global numpy random state if not given
         """
 
         if image_size is None:
@@ -38,18 +50,26 @@ class RestrictedBoltzmannMachine:
             self.n_labels = 10
 
         self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
         self.delta_bias_v = 0
         self.delta_weight_vh = 0
         self.delta_bias_h = 0
-        self.bias_v = np.random.normal(loc=0.0, scale=0.01, size=self.ndim_visible)
-        self.weight_vh = np.random.normal(loc=0.0, scale=0.01, size=(self.ndim_visible, self.ndim_hidden))
-        self.bias_h = np.random.normal(loc=0.0, scale=0.01, size=self.ndim_hidden)
+        self.bias_v = np.random.normal(loc=0.0, scale=0.01, size=self.ndim_visible).astype(self.dtype)
+        self.weight_vh = np.random.normal(loc=0.0, scale=0.01,
+                                          size=(self.ndim_visible, self.ndim_hidden)).astype(self.dtype)
+        self.bias_h = np.random.normal(loc=0.0, scale=0.01, size=self.ndim_hidden).astype(self.dtype)
         self.delta_weight_v_to_h = 0
         self.delta_weight_h_to_v = 0
         self.weight_v_to_h = None
         self.weight_h_to_v = None
-        self.learning_rate = 0.01
+        self.learning_rate = 0.001  # with momentum 0.7, see case "optimizer" of benchmark.py
         self.momentum = 0.7
+        self.weight_decay = 0.  # L2 penalty on the weights, biases are not decayed
+        self.learning_rate_schedule = None  # optional callable epoch -> learning rate, replaces "learning_rate"
+        self.epoch = 0  # current training epoch, set by 'cd1' and the wake-sleep loop, used by the schedule
+        self.cd_k = 1  # Gibbs steps of the negative phase of 'cd1'
+        self.n_fantasy = 0  # number of persistent fantasy particles (PCD), 0 restarts the chains from the data
+        self.fantasy_hidden = None  # hidden activations of the fantasy particles, see 'advance_fantasy'
         self.print_period = 5000
 
         self.rf = {  # receptive-fields. Only applicable when visible layer is input data
@@ -58,93 +78,305 @@ class RestrictedBoltzmannMachine:
             "ids": np.random.randint(0, self.ndim_hidden, 25)  # pick some random hidden units
         }
 
+        self.workspace = None  # preallocated minibatch buffers, see 'allocate_workspace'
+
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.random = RandomStream(seed, dtype=self.dtype)
+
+        # minibatch order of 'cd1', a new permutation every epoch (see util.MinibatchSampler). With a block size, blocks
+        # of that many consecutive samples are shuffled instead, which keeps reads of memory-mapped data sequential
+        self.shuffle_seed = int(self.random.seed_sequence.spawn(1)[0].generate_state(1)[0])
+        self.shuffle_block_size = None
+
+        # sparse visible data for the bottom rbm: True, False or "auto" (sparse below SPARSE_DENSITY_THRESHOLD)
+        self.sparse_input = "auto"
+        self.sparse_resolved = None  # "sparse_input" decided on the training set by 'resolve_sparse_input'
+
         return
 
-    def cd1(self, visible_trainset, n_iterations=100, plotting=False):
+    def cd1(self, visible_trainset, n_iterations=100, plotting=False, in_place=False, checkpoint=None,
+            checkpoint_period=1000, monitor=True, tol=None, viz=None):
 
         """Contrastive Divergence with k=1 full alternating Gibbs sampling
 
+        The negative phase runs "cd_k" Gibbs steps from the data (CD-k). If "n_fantasy" is set, it advances that many
+        persistent fantasy particles by "cd_k" steps instead (PCD-k, see 'advance_fantasy'), which are kept across
+        minibatches and epochs and written to checkpoints.
+
+        Every epoch visits the training set in a new order drawn from "shuffle_seed" (see util.MinibatchSampler); the
+        last minibatch of an epoch holds the remaining samples if "batch_size" does not divide the training set.
+
+        The reconstruction loss ||v_0 - p(v_1|h_0)|| / batch size is taken from the probabilities the CD step computes
+        anyway, so monitoring costs no extra Gibbs passes (with PCD, p(v_1|h_0) costs one product per minibatch). It
+        is averaged per epoch and printed at the end of each.
+
         Args:
           visible_trainset: training data for this rbm, shape is (size of training set, size of visible layer)
           n_iterations: number of iterations of learning (each iteration learns a mini-batch)
-          plotting: set to True to plot (default = True)
+          plotting: set to True to plot the reconstruction loss of every minibatch at the end (default = True)
+          in_place: set to True to run every minibatch in preallocated buffers (see 'cd1_step_inplace')
+          checkpoint: file name of a checkpoint written every "checkpoint_period" minibatches. If the file exists,
+          training resumes from the minibatch after the checkpoint. The file is removed once training is complete.
+          The reconstruction losses are not part of the checkpoint.
+          checkpoint_period: number of minibatches between checkpoints, counted over all epochs
+          monitor: set to False to skip the reconstruction loss entirely
+          tol: stop early once the relative improvement of the epoch loss over the previous epoch drops below "tol"
+          viz: util.VisualizationSink that renders the receptive fields of the bottom rbm every rf["period"]
+          minibatches ('viz_rf'). Training does not wait for it, snapshots that cannot be queued are coalesced
+        Returns:
+          list of the average reconstruction loss of each epoch (empty if "monitor" is False)
         """
 
-        n_samples = visible_trainset.shape[0]
-        loss_list = []
-        results_list = []
-        error = []  # Storing error per iteration
-        elements = int(n_samples / self.batch_size)
-        current_epoch = 1  # Initialize current epoch as the first one
-        for epoch in range(n_iterations):
-            for it in tqdm(range(elements)):
+        if in_place:
+            self.allocate_workspace()
+        self.resolve_sparse_input(visible_trainset)
+        visible_trainset = self.prepare_visible(visible_trainset)
+
+        start_epoch, start_it = 0, 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            start_epoch, start_it = self.loadfromfile_checkpoint(checkpoint)
+            print("resuming from %s at epoch %d, iteration %d" % (checkpoint, start_epoch, start_it))
+
+        sampler = MinibatchSampler([visible_trainset], self.batch_size, seed=self.shuffle_seed,
+                                   block_size=self.shuffle_block_size)
+        epoch_losses = []
+        batch_losses = []  # Storing loss per minibatch, for plotting only
+        elements = len(sampler)
+        for epoch in range(start_epoch, n_iterations):
+            self.epoch = epoch
+            loss_sum, n_batches = 0., 0
+            start = start_it if epoch == start_epoch else 0
+            for it, (v_0,) in enumerate(tqdm(sampler.epoch(epoch, start), total=elements - start), start):
 
                 # [TODO TASK 4.1] run k=1 alternating Gibbs sampling : v_0 -> h_0 ->  v_1 -> h_1. you may need to
                 #  use the inference functions 'get_h_given_v' and 'get_v_given_h'. note that inference methods returns
                 #  both probabilities and activations (samples from probablities) and you may have to decide when to use
                 #  what.
 
-                index_init = int(it % elements)
-                index_stop = int((index_init + 1) * self.batch_size)
-                index_init *= self.batch_size
-                v_0 = visible_trainset[index_init:index_stop, :]
-                p_h_given_v_0, h_0 = self.get_h_given_v(v_0)
-                # Negative phase
-                p_v_given_h_1, v_1 = self.get_v_given_h(h_0)
-                p_h_given_v_0, h_1 = self.get_h_given_v(v_1)
-
-                # [TODO TASK 4.1] update the parameters using function 'update_params'
-
-                self.update_params(v_0, h_0, v_1, h_1)
-
-                if plotting:
-                    if it % self.batch_size == 0:
-                        hidden_restored = self.get_h_given_v(v_0)[1]
-                        restored_image = self.get_v_given_h(hidden_restored)[1]
-                        error.append(np.linalg.norm(v_0 - restored_image))
-
-                    if current_epoch >= 10:
-                        # Restoring image
-                        hidden_restored = self.get_h_given_v(v_0)[1]
-                        restored_image = self.get_v_given_h(hidden_restored)[1]
-                        loss_function = np.linalg.norm(v_0 - restored_image) / self.batch_size
-                        loss_list.append(loss_function)  # Store last 10 percent
-                        if it == elements - 1:
-                            # Last iteration before emptying the list
-                            results_list.append(np.array(loss_list).sum() / len(loss_list))  # Append avg loss epoch
-                            loss_list = []  # Empty list
-
-                    # if it % self.print_period == 0:
-                    #     loss_function = np.linalg.norm(v_0 - v_1) / self.batch_size
-                    #     print("\niteration=%7d recon_loss=%4.4f" % (it, loss_function))
-
-            # if self.is_bottom:
-            #     viz_rf(weights=self.weight_vh[:, self.rf["ids"]].reshape((self.image_size[0],
-            #     self.image_size[1], -1)),
-            #            epoch=epoch * epoch_size, grid=self.rf["grid"])
-
-            current_epoch += 1  # Update current epoch
+                if in_place:
+                    self.cd1_step_inplace(v_0, reconstruct=monitor)
+                    p_v_given_h_1 = self.workspace["p_v_1"][:v_0.shape[0]]
+                elif self.n_fantasy:
+                    p_h_given_v_0, h_0 = self.get_h_given_v(v_0)
+                    if monitor:
+                        p_v_given_h_1 = self.get_v_given_h(h_0, out=(np.empty((h_0.shape[0], self.ndim_visible),
+                                                                              dtype=self.dtype), None))[0]
+                    v_k, h_k = self.advance_fantasy(h_0)
+                    self.update_params(v_0, h_0, v_k, h_k)
+                else:
+                    p_h_given_v_0, h_0 = self.get_h_given_v(v_0)
+                    # Negative phase
+                    p_v_given_h_1, v_1 = self.get_v_given_h(h_0)
+                    p_h_given_v_0, h_1 = self.get_h_given_v(v_1)
+                    for step in range(1, self.cd_k):
+                        v_1 = self.get_v_given_h(h_1)[1]
+                        h_1 = self.get_h_given_v(v_1)[1]
+
+                    # [TODO TASK 4.1] update the parameters using function 'update_params'
+
+                    self.update_params(v_0, h_0, v_1, h_1)
+
+                if monitor:
+                    loss = self.reconstruction_loss(v_0, p_v_given_h_1)
+                    loss_sum += loss
+                    n_batches += 1
+                    if plotting:
+                        batch_losses.append(loss)
+
+                # the periods count minibatches over all epochs, an epoch may be shorter than a period
+                step = epoch * elements + it + 1
+                if checkpoint is not None and step % checkpoint_period == 0:
+                    self.savetofile_checkpoint(checkpoint, epoch, it + 1)
+
+                if viz is not None and self.is_bottom and step % self.rf["period"] == 0:
+                    # indexing with the list of ids copies the columns, later updates do not touch the snapshot
+                    viz.submit(viz_rf, self.weight_vh[:, self.rf["ids"]].reshape((self.image_size[0],
+                                                                                    self.image_size[1], -1)),
+                               step, self.rf["grid"], key="rf")
+
+            if monitor and n_batches > 0:
+                epoch_losses.append(loss_sum / n_batches)
+                print("epoch=%4d recon_loss=%4.4f" % (epoch, epoch_losses[-1]))
+
+                if tol is not None and len(epoch_losses) > 1 and \
+                        epoch_losses[-2] - epoch_losses[-1] < tol * epoch_losses[-2]:
+                    print("stopping early, relative improvement below %g" % tol)
+                    break
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
 
         if plotting:
-            plt.plot(range(len(error)), error)
+            plt.plot(range(len(batch_losses)), batch_losses)
             plt.xlabel("Batch")
-            plt.ylabel("Error")
+            plt.ylabel("Reconstruction loss")
             plt.show()
 
-        return results_list
+        return epoch_losses
+
+    def reconstruction_loss(self, v_0, p_v_1):
+
+        """Reconstruction loss ||v_0 - p(v_1|h_0)|| / size of mini-batch
+
+        Args:
+          v_0: visible minibatch
+          p_v_1: visible probabilities of the negative phase for "v_0"
+        """
+
+        diff = np.subtract(to_dense(v_0), p_v_1,
+                           out=None if self.workspace is None else self.workspace["diff_v"][:v_0.shape[0]])
+        return float(np.sqrt(np.vdot(diff, diff))) / v_0.shape[0]
+
+    def cd1_parallel(self, visible_trainset, n_iterations=100, n_workers=2, seed=None):
+
+        """Data-parallel Contrastive Divergence with k=1 over "n_workers" processes
+
+        Every step, each worker computes the gradients of its own minibatch (worker i takes minibatch
+        step * n_workers + i) with 'cd1_gradients_inplace'. The parent averages the gradients of all workers in a fixed
+        order and updates the parameters, which live in shared memory, before the next step starts. A run is therefore
+        bit-reproducible for a fixed seed and number of workers. The averaged gradients go through the same momentum
+        and weight decay step as 'update_params'.
+
+        Unlike 'cd1', this path visits the training set in its fixed order and drops the samples that do not fill a
+        whole step of "n_workers" full minibatches: every worker must have a minibatch of batch_size samples each step,
+        because the plain mean over the workers' gradients (and their fixed-size shared buffers) assumes equal
+        minibatches.
+
+        Workers are forked, so this needs a platform with the "fork" start method. Setting OMP_NUM_THREADS=1 (or the
+        equivalent of your BLAS) avoids oversubscribing the cores.
+
+        Args:
+          visible_trainset: training data for this rbm, shape is (size of training set, size of visible layer)
+          n_iterations: number of epochs
+          n_workers: number of worker processes
+          seed: seed of the worker random streams. Drawn from the random stream of this rbm if not given
+        """
+
+        import multiprocessing
+
+        if seed is None:
+            seed = int(self.random.generator.integers(2 ** 31))
+        self.resolve_sparse_input(visible_trainset)
+        visible_trainset = self.prepare_visible(visible_trainset)
+        n_steps = visible_trainset.shape[0] // (self.batch_size * n_workers)
+
+        param_shapes = [self.weight_vh.shape, self.bias_v.shape, self.bias_h.shape]
+        param_shm, (weight_vh, bias_v, bias_h) = _shared_arrays(param_shapes, self.dtype)
+        grad_shm, (grad_weight_vh, grad_bias_v, grad_bias_h) = _shared_arrays(
+            [(n_workers,) + shape for shape in param_shapes], self.dtype)
+
+        weight_vh[...], bias_v[...], bias_h[...] = self.weight_vh, self.bias_v, self.bias_h
+        self.weight_vh, self.bias_v, self.bias_h = weight_vh, bias_v, bias_h
+        ws = self.allocate_workspace()
+
+        ctx = multiprocessing.get_context("fork")
+        barrier = ctx.Barrier(n_workers + 1)
+        workers = [ctx.Process(target=_cd1_parallel_worker,
+                               args=(self, visible_trainset, (grad_weight_vh[i], grad_bias_v[i], grad_bias_h[i]),
+                                     i, n_workers, n_steps * n_iterations, child_seed, barrier))
+                   for i, child_seed in enumerate(np.random.SeedSequence(seed).spawn(n_workers))]
+
+        try:
+            for worker in workers:
+                worker.start()
+
+            for epoch in range(n_iterations):
+                self.epoch = epoch
+                for step in tqdm(range(n_steps)):
+                    barrier.wait()  # parameters are ready, workers compute gradients
+                    barrier.wait()  # gradients are ready
+
+                    self.apply_update("weight_vh", np.mean(grad_weight_vh, axis=0, out=ws["grad_vh"]))
+                    self.apply_update("bias_v", np.mean(grad_bias_v, axis=0, out=ws["grad_v"]))
+                    self.apply_update("bias_h", np.mean(grad_bias_h, axis=0, out=ws["grad_h"]))
+
+            for worker in workers:
+                worker.join()
+
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            self.weight_vh, self.bias_v, self.bias_h = np.copy(weight_vh), np.copy(bias_v), np.copy(bias_h)
+            del weight_vh, bias_v, bias_h, grad_weight_vh, grad_bias_v, grad_bias_h
+            for shm in (param_shm, grad_shm):
+                shm.close()
+                shm.unlink()
+
+        return
+
+    def get_state(self):
+
+        """Parameters and momentum buffers of this rbm by attribute name. Unset ones (None or 0) are left out."""
+
+        return {key: getattr(self, key) for key in STATE_ARRAYS if isinstance(getattr(self, key), np.ndarray)}
+
+    def set_state(self, state):
+
+        """Inverse of 'get_state'. Weights missing from "state" are set to None, momentum buffers to 0."""
+
+        for key in STATE_ARRAYS:
+            if key in state:
+                setattr(self, key, state[key])
+            elif key.startswith("weight"):
+                setattr(self, key, None)
+            elif not key.startswith("bias"):
+                setattr(self, key, 0)
+
+        return
+
+    def savetofile_checkpoint(self, filename, epoch, iteration):
+
+        """Write parameters, momentum buffers, random states and the training position to a checkpoint file
+
+        Args:
+          filename: checkpoint file (see util.save_checkpoint)
+          epoch: epoch to resume from
+          iteration: minibatch within "epoch" to resume from
+        """
+
+        arrays, random_state = get_random_state()
+        arrays.update(self.get_state())
+        meta = {"epoch": epoch, "iteration": iteration, "batch_size": self.batch_size, "random_state": random_state,
+                "random_stream": self.random.state, "shuffle_seed": self.shuffle_seed}
+        save_checkpoint(filename, arrays, meta)
+
+        return
+
+    def loadfromfile_checkpoint(self, filename):
+
+        """Restore the state written by 'savetofile_checkpoint'
+
+        Returns:
+          tuple (epoch, iteration) to resume from
+        """
+
+        arrays, meta = load_checkpoint(filename)
+        if meta["batch_size"] != self.batch_size or arrays["weight_vh"].shape != (self.ndim_visible, self.ndim_hidden):
+            raise ValueError("checkpoint %s does not match this rbm" % filename)
+
+        self.set_state({key: value for key, value in arrays.items() if key in STATE_ARRAYS})
+        set_random_state(arrays, meta["random_state"])
+        self.random.state = meta["random_stream"]
+        self.shuffle_seed = meta.get("shuffle_seed", self.shuffle_seed)
+
+        return meta["epoch"], meta["iteration"]
 
     def update_params(self, v_0, h_0, v_k, h_k):
 
         """Update the weight and bias parameters.
 
-        You could also add weight decay and momentum for weight updates.
+        The gradients are applied with momentum and weight decay, see 'apply_update'. Once a workspace is allocated
+        (see 'allocate_workspace'), the gradients are computed in its buffers.
 
         Args:
            v_0: activities or probabilities of visible layer (data to the rbm)
            h_0: activities or probabilities of hidden layer
            v_k: activities or probabilities of visible layer
            h_k: activities or probabilities of hidden layer
-           all args have shape (size of mini-batch, size of respective layer)
+           all args have shape (size of mini-batch, size of respective layer). v_k and h_k may have a different
+           number of rows (fantasy particles), their statistics are scaled to the size of the mini-batch
         """
 
         # DONE
@@ -152,24 +384,292 @@ class RestrictedBoltzmannMachine:
         #  update the weight and bias parameters
         # equation 9
 
-        self.delta_bias_v = self.learning_rate * (np.sum(v_0 - v_k, axis=0)) # /v_0.shape[0]
-        self.delta_weight_vh = self.learning_rate * ((v_0.T @ h_0) - (v_k.T @ h_k))
-        self.delta_bias_h = self.learning_rate * (np.sum(h_0 - h_k, axis=0))  #/h_0.shape[0]
+        if self.workspace is not None:
+            grad_weight_vh, grad_bias_v, grad_bias_h = self._gradients_inplace(v_0, h_0, v_k, h_k)
+        elif v_k.shape[0] != v_0.shape[0]:
+            scale = v_0.shape[0] / v_k.shape[0]
+            grad_bias_v = column_sum(v_0) - scale * np.sum(v_k, axis=0)
+            grad_weight_vh = (v_0.T @ h_0) - scale * (v_k.T @ h_k)
+            grad_bias_h = np.sum(h_0, axis=0) - scale * np.sum(h_k, axis=0)
+        else:
+            if issparse(v_0):
+                grad_bias_v = column_sum(v_0) - np.sum(v_k, axis=0)
+            else:
+                grad_bias_v = np.sum(v_0 - v_k, axis=0)  # /v_0.shape[0]
+            grad_weight_vh = (v_0.T @ h_0) - (v_k.T @ h_k)
+            grad_bias_h = np.sum(h_0 - h_k, axis=0)  #/h_0.shape[0]
 
-        self.bias_v += self.delta_bias_v
-        self.weight_vh += self.delta_weight_vh
-        self.bias_h += self.delta_bias_h
+        self.apply_update("bias_v", grad_bias_v)
+        self.apply_update("weight_vh", grad_weight_vh)
+        self.apply_update("bias_h", grad_bias_h)
 
         return
 
-    def get_h_given_v(self, visible_minibatch):
+    def apply_update(self, name, gradient):
+
+        """Step of the parameter "name" (e.g. "weight_vh") along "gradient" with 'util.momentum_step'.
+
+        The velocity is the persistent array "delta_<name>", zero on first use and kept in checkpoints. The learning
+        rate is "learning_rate", or learning_rate_schedule(epoch) if a schedule is set. Only weights are decayed.
+        "gradient" is overwritten.
+        """
+
+        param = getattr(self, name)
+        velocity = getattr(self, "delta_" + name)
+        if not isinstance(velocity, np.ndarray) or velocity.shape != param.shape:
+            velocity = np.zeros(param.shape, dtype=self.dtype)
+            setattr(self, "delta_" + name, velocity)
+
+        learning_rate = self.learning_rate
+        if self.learning_rate_schedule is not None:
+            learning_rate = self.learning_rate_schedule(self.epoch)
+
+        momentum_step(param, velocity, gradient, learning_rate, self.momentum,
+                      self.weight_decay if name.startswith("weight") else 0.)
+
+        return
+
+    def allocate_workspace(self):
+
+        """Preallocate the buffers used by 'cd1_step_inplace' and the update functions.
+
+        The minibatch buffers are sized from "batch_size", the gradient buffers "grad_*" from the weight matrix. The
+        velocities ("delta_*" attributes) are left alone, so momentum carries over a (re)allocation.
+        """
+
+        ws = self.workspace
+        if ws is not None and ws["v_1"].shape[0] == self.batch_size:
+            return ws
+
+        batch, n_v, n_h, dtype = self.batch_size, self.ndim_visible, self.ndim_hidden, self.dtype
+        ws = {
+            "p_h_0": np.empty((batch, n_h), dtype=dtype),
+            "h_0": np.empty((batch, n_h), dtype=dtype),
+            "p_v_1": np.empty((batch, n_v), dtype=dtype),
+            "v_1": np.empty((batch, n_v), dtype=dtype),
+            "p_h_1": np.empty((batch, n_h), dtype=dtype),
+            "h_1": np.empty((batch, n_h), dtype=dtype),
+            "diff_v": np.empty((batch, n_v), dtype=dtype),
+            "diff_h": np.empty((batch, n_h), dtype=dtype),
+            "neg_vh": np.empty((n_v, n_h), dtype=dtype),
+            "neg_v": np.empty(n_v, dtype=dtype),
+            "neg_h": np.empty(n_h, dtype=dtype),
+            "grad_vh": np.empty((n_v, n_h), dtype=dtype),
+            "grad_v": np.empty(n_v, dtype=dtype),
+            "grad_h": np.empty(n_h, dtype=dtype),
+        }
+
+        self.workspace = ws
+        return ws
+
+    def batch_workspace(self, n_rows):
+
+        """The workspace with its minibatch buffers cut to their first "n_rows" rows (views), for the last minibatch
+        of an epoch when "batch_size" does not divide the training set. The workspace itself if "n_rows" is batch_size
+        """
+
+        ws = self.workspace
+        if n_rows == ws["v_1"].shape[0]:
+            return ws
+        return dict(ws, **{key: ws[key][:n_rows] for key in MINIBATCH_BUFFERS})
+
+    def cd1_step_inplace(self, v_0, reconstruct=True):
+
+        """One v_0 -> h_0 -> v_1 -> h_1 -> update step of CD-1 without allocating minibatch or weight sized arrays.
+
+        Same computation as 'get_h_given_v', 'get_v_given_h' and 'update_params', but every intermediate result is
+        written into the buffers of 'allocate_workspace'. Runs CD-k or PCD-k instead if "cd_k" or "n_fantasy" are set.
+
+        Args:
+          v_0: visible minibatch shaped (batch_size or fewer, size of visible layer)
+          reconstruct: with PCD, also compute p(v_1|h_0) in workspace["p_v_1"] for the reconstruction loss
+        """
+
+        self.cd1_gradients_inplace(v_0, reconstruct)
+
+        ws = self.workspace
+        self.apply_update("weight_vh", ws["grad_vh"])
+        self.apply_update("bias_v", ws["grad_v"])
+        self.apply_update("bias_h", ws["grad_h"])
+
+        return
+
+    def cd1_gradients_inplace(self, v_0, reconstruct=True):
+
+        """Run v_0 -> h_0 -> v_1 -> h_1 in the workspace buffers and store the gradients in "grad_*" of the workspace.
+
+        The chain continues for "cd_k" steps in total. With "n_fantasy" particles, the negative phase is
+        'advance_fantasy' instead and p(v_1|h_0) is only computed if "reconstruct" is set. The parameters themselves are
+        not changed, see 'cd1_step_inplace'.
+
+        Args:
+          v_0: visible minibatch shaped (batch_size or fewer, size of visible layer), see 'batch_workspace'
+          reconstruct: see 'cd1_step_inplace'
+        """
+
+        ws = self.batch_workspace(v_0.shape[0])
+        uniform = self.random.uniform
+
+        # positive phase
+        dot(v_0, self.weight_vh, out=ws["p_h_0"])
+        ws["p_h_0"] += self.bias_h
+        sigmoid(ws["p_h_0"], out=ws["p_h_0"])
+        sample_binary(ws["p_h_0"], out=ws["h_0"], rand=uniform(ws["h_0"].shape))
+
+        if self.n_fantasy:
+            if reconstruct:
+                self.get_v_given_h(ws["h_0"], out=(ws["p_v_1"], None))
+            self._gradients_inplace(v_0, ws["h_0"], *self.advance_fantasy(ws["h_0"]))
+            return
+
+        # negative phase
+        np.matmul(ws["h_0"], self.weight_vh.T, out=ws["p_v_1"])
+        ws["p_v_1"] += self.bias_v
+        if self.is_top:
+            self._visible_activation_inplace(ws["p_v_1"], ws["v_1"])
+        else:
+            sigmoid(ws["p_v_1"], out=ws["p_v_1"])
+            sample_binary(ws["p_v_1"], out=ws["v_1"], rand=uniform(ws["v_1"].shape))
+
+        np.matmul(ws["v_1"], self.weight_vh, out=ws["p_h_1"])
+        ws["p_h_1"] += self.bias_h
+        sigmoid(ws["p_h_1"], out=ws["p_h_1"])
+        sample_binary(ws["p_h_1"], out=ws["h_1"], rand=uniform(ws["h_1"].shape))
+
+        # further steps reuse the v_1 and h_1 buffers, p(v_1|h_0) stays for the reconstruction loss
+        for step in range(1, self.cd_k):
+            self.get_v_given_h(ws["h_1"], out=(ws["diff_v"], ws["v_1"]))
+            self.get_h_given_v(ws["v_1"], out=(ws["p_h_1"], ws["h_1"]))
+
+        self._gradients_inplace(v_0, ws["h_0"], ws["v_1"], ws["h_1"])
+
+        return
+
+    def advance_fantasy(self, h_0):
+
+        """Advance the persistent fantasy particles of PCD-k by "cd_k" block Gibbs steps h -> v -> h.
+
+        For more details : Tieleman (2008). Training Restricted Boltzmann Machines using Approximations to the
+        Likelihood Gradient. https://www.cs.toronto.edu/~tijmen/pcd/pcd.pdf
+
+        The "n_fantasy" chains are stored as their hidden activations in "fantasy_hidden" (part of checkpoints). They
+        start from the rows of "h_0", repeated, the first time or when "n_fantasy" changed. All chains run as one
+        batch, through buffers in the workspace if one is allocated.
+
+        Args:
+          h_0: hidden activations of the positive phase, shaped (size of mini-batch, size of hidden layer)
+        Returns:
+          tuple (visible activations, hidden activations) of the particles, shaped (n_fantasy, size of layer)
+        """
+
+        n, n_v, n_h = self.n_fantasy, self.ndim_visible, self.ndim_hidden
+        if not isinstance(self.fantasy_hidden, np.ndarray) or self.fantasy_hidden.shape != (n, n_h):
+            self.fantasy_hidden = np.resize(np.asarray(h_0, dtype=self.dtype), (n, n_h))
+
+        buffers = self.workspace if self.workspace is not None else {}
+        if "fantasy_v" not in buffers or buffers["fantasy_v"].shape != (n, n_v):
+            buffers["fantasy_p_v"] = np.empty((n, n_v), dtype=self.dtype)
+            buffers["fantasy_v"] = np.empty((n, n_v), dtype=self.dtype)
+            buffers["fantasy_p_h"] = np.empty((n, n_h), dtype=self.dtype)
+
+        for step in range(self.cd_k):
+            self.get_v_given_h(self.fantasy_hidden, out=(buffers["fantasy_p_v"], buffers["fantasy_v"]))
+            self.get_h_given_v(buffers["fantasy_v"], out=(buffers["fantasy_p_h"], self.fantasy_hidden))
+
+        return buffers["fantasy_v"], self.fantasy_hidden
+
+    def _gradients_inplace(self, v_0, h_0, v_k, h_k):
+
+        """Gradients of 'update_params' written into the "grad_*" buffers of the workspace, returned in the order
+        weight, visible bias, hidden bias"""
+
+        ws = self.workspace
+
+        np.matmul(v_k.T, h_k, out=ws["neg_vh"])
+        np.sum(v_k, axis=0, out=ws["neg_v"])
+        np.sum(h_k, axis=0, out=ws["neg_h"])
+        if v_k.shape[0] != v_0.shape[0]:  # statistics of more or fewer fantasy particles than samples
+            for key in ["neg_vh", "neg_v", "neg_h"]:
+                ws[key] *= v_0.shape[0] / v_k.shape[0]
+
+        dot(v_0.T, h_0, out=ws["grad_vh"])
+        ws["grad_vh"] -= ws["neg_vh"]
+
+        column_sum(v_0, out=ws["grad_v"])
+        ws["grad_v"] -= ws["neg_v"]
+
+        np.sum(h_0, axis=0, out=ws["grad_h"])
+        ws["grad_h"] -= ws["neg_h"]
+
+        return ws["grad_vh"], ws["grad_v"], ws["grad_h"]
+
+    def _visible_activation_inplace(self, support, activations):
+
+        """Turn the visible support of the top rbm into probabilities and activations in place.
+
+        Data units get sigmoid/binary sampling, label units softmax/categorical sampling. Everything is written into
+        "support" (probabilities) and "activations", only the label units need small (batch, n_labels) temporaries.
+        If "activations" is None, only the probabilities are computed.
+        """
+
+        n_labels = self.n_labels
+        data, labels = support[:, :-n_labels], support[:, -n_labels:]
+
+        sigmoid(data, out=data)
+        softmax(labels, out=labels)
+        if activations is None:
+            return
+
+        sample_binary(data, out=activations[:, :-n_labels], rand=self.random.uniform(data.shape))
+        sample_categorical(labels, rand=self.random.uniform((labels.shape[0],)), out=activations[:, -n_labels:])
+
+        return
+
+    def resolve_sparse_input(self, visible_trainset):
+
+        """Decide once, on the training set, whether the bottom rbm works on CSR data and store it in
+        "sparse_resolved": True if "sparse_input" is True, or if it is "auto" and the training set is sparse or its
+        measured density is below SPARSE_DENSITY_THRESHOLD. Called by 'cd1' and 'cd1_parallel'.
+        """
+
+        if not self.is_bottom or self.sparse_input is False:
+            self.sparse_resolved = False
+        elif self.sparse_input == "auto":
+            self.sparse_resolved = issparse(visible_trainset) or (visible_trainset.shape[0] > 0 and
+                                                                 density(visible_trainset) < SPARSE_DENSITY_THRESHOLD)
+        else:
+            self.sparse_resolved = True
+
+        return self.sparse_resolved
+
+    def prepare_visible(self, visible_data):
+
+        """Visible data in the representation the products of this rbm are fastest with.
+
+        For the bottom rbm, dense data is converted to a CSR matrix if 'resolve_sparse_input' chose sparse products
+        on the training set. Before any training, that is only the case if "sparse_input" is True, so batches seen
+        at inference time never switch representation by their own density. 'get_h_given_v', 'get_h_given_v_dir'
+        and the positive phase of the CD gradients accept both representations. Other rbms and data without rows
+        are returned unchanged.
+        """
+
+        if not self.is_bottom or issparse(visible_data) or visible_data.shape[0] == 0:
+            return visible_data
+        sparse = self.sparse_input is True if self.sparse_resolved is None else self.sparse_resolved
+        if not sparse:
+            return visible_data
+        return to_sparse(visible_data)
+
+    def get_h_given_v(self, visible_minibatch, out=None):
 
         """Compute probabilities p(h|v) and activations h ~ p(h|v) 
 
         Uses undirected weight "weight_vh" and bias "bias_h"
         
         Args: 
-           visible_minibatch: shape is (size of mini-batch, size of visible layer)
+           visible_minibatch: shape is (size of mini-batch, size of visible layer), dense or scipy sparse
+           out: optional tuple of two preallocated arrays to write the probabilities and activations into. If the
+           activation array is None, only the probabilities are computed and no random numbers are drawn
         Returns:        
            tuple ( p(h|v) , h) 
            both are shaped (size of mini-batch, size of hidden layer)
@@ -183,12 +683,15 @@ class RestrictedBoltzmannMachine:
         #  (samples from probabilities) of hidden layer (replace the zeros below)
         # equation 10 
 
-        p_h_given_v = sigmoid(visible_minibatch @ self.weight_vh + self.bias_h)
-        h = sample_binary(p_h_given_v)
+        if out is not None:
+            return self._sigmoid_layer_inplace(visible_minibatch, self.weight_vh, self.bias_h, out)
+
+        p_h_given_v = sigmoid(dot(visible_minibatch, self.weight_vh) + self.bias_h)
+        h = sample_binary(p_h_given_v, rand=self.random.uniform(p_h_given_v.shape))
 
         return p_h_given_v, h
 
-    def get_v_given_h(self, hidden_minibatch):
+    def get_v_given_h(self, hidden_minibatch, out=None):
 
         """Compute probabilities p(v|h) and activations v ~ p(v|h)
 
@@ -196,6 +699,9 @@ class RestrictedBoltzmannMachine:
         
         Args: 
            hidden_minibatch: shape is (size of mini-batch, size of hidden layer)
+           out: optional tuple of two preallocated arrays to write the probabilities and activations into. Gibbs
+           chains can pass the same pair on every step, as long as they are done with the previous activations. The
+           activation array may be None to compute the probabilities only
         Returns:        
            tuple ( p(v|h) , v) 
            both are shaped (size of mini-batch, size of visible layer)
@@ -221,28 +727,81 @@ class RestrictedBoltzmannMachine:
             # Note that this section can also be postponed until TASK 4.2, since in this task,
             # stand-alone RBMs do not contain labels in visible layer.
 
-            support = hidden_minibatch @ self.weight_vh.T + self.bias_v
-
-            # Create arrays
-            p_v_given_h = np.ndarray(shape=support.shape)
-            s = np.ndarray(shape=support.shape)
+            # the support is computed directly in the probability buffer and turned into probabilities and
+            # activations in place, see '_visible_activation_inplace'
+            if out is None:
+                out = (np.empty((n_samples, self.ndim_visible), dtype=self.dtype),
+                       np.empty((n_samples, self.ndim_visible), dtype=self.dtype))
+            p_v_given_h, s = out
 
-            # Compute probabilities only for visible layer
-            p_v_given_h[:, :-self.n_labels] = sigmoid(support[:, :-self.n_labels])
-            p_v_given_h[:, -self.n_labels:] = softmax(support[:, -self.n_labels:])
-            s[:, :-self.n_labels] = sample_binary(p_v_given_h[:, :-self.n_labels])
-            s[:, -self.n_labels:] = sample_categorical(p_v_given_h[:, -self.n_labels:])
+            np.matmul(hidden_minibatch, self.weight_vh.T, out=p_v_given_h)
+            p_v_given_h += self.bias_v
+            self._visible_activation_inplace(p_v_given_h, s)
 
         else:
             # DONE           
             # [TODO TASK 4.1] compute probabilities and activations (samples from probabilities)
             #  of visible layer (replace the pass and zeros below)
             # equation 11
+            if out is not None:
+                return self._sigmoid_layer_inplace(hidden_minibatch, self.weight_vh.T, self.bias_v, out)
+
             p_v_given_h = sigmoid(hidden_minibatch @ self.weight_vh.T + self.bias_v)
-            s = sample_binary(p_v_given_h)
+            s = sample_binary(p_v_given_h, rand=self.random.uniform(p_v_given_h.shape))
 
         return p_v_given_h, s
 
+    def _sigmoid_layer_inplace(self, inputs, weights, bias, out):
+
+        """Probabilities sigmoid(inputs @ weights + bias) and binary activations written into the pair "out".
+
+        The activations are skipped if out[1] is None.
+        """
+
+        probabilities, activations = out
+        dot(inputs, weights, out=probabilities)
+        probabilities += bias
+        sigmoid(probabilities, out=probabilities)
+        if activations is not None:
+            sample_binary(probabilities, out=activations, rand=self.random.uniform(activations.shape))
+
+        return probabilities, activations
+
+    def free_energy(self, visible_minibatch):
+
+        """Free energy F(v) = -v.b_v - sum_j log(1 + exp((v W + b_h)_j)), so that p(v) is proportional to exp(-F(v))
+
+        Args:
+           visible_minibatch: shape is (size of mini-batch, size of visible layer), dense or scipy sparse
+        Returns:
+           F(v), shaped (size of mini-batch,)
+        """
+
+        support = dot(visible_minibatch, self.weight_vh) + self.bias_h
+        return -dot(visible_minibatch, self.bias_v) - np.sum(np.logaddexp(0., support), axis=1)
+
+    def classify_free_energy(self, data):
+
+        """Exact label posterior p(label|data) of the top rbm, without sampling.
+
+        The free energy of data+onehot(label) differs between the labels only by the label bias and the label row of
+        the weights, so a single product data @ W[data rows] is shared by all labels and each label adds one row to it
+        before the softplus sum (util.label_posterior).
+
+        Args:
+           data: shape is (size of mini-batch, size of visible layer - n_labels), the non-label visible units
+        Returns:
+           tuple ( labels , p(label|data) ) shaped (size of mini-batch,) and (size of mini-batch, n_labels)
+        """
+
+        assert self.is_top and self.weight_vh is not None
+        n_labels = self.n_labels
+        n_data = self.ndim_visible - n_labels
+
+        support = dot(data, self.weight_vh[:n_data])
+        support += self.bias_h
+        return label_posterior(support, self.weight_vh[n_data:], self.bias_v[n_data:])
+
     """ rbm as a belief layer : the functions below do not have to be changed until running a deep belief net """
 
     def untwine_weights(self):
@@ -251,14 +810,15 @@ class RestrictedBoltzmannMachine:
         self.weight_h_to_v = np.copy(np.transpose(self.weight_vh))
         self.weight_vh = None
 
-    def get_h_given_v_dir(self, visible_minibatch):
+    def get_h_given_v_dir(self, visible_minibatch, out=None):
 
         """Compute probabilities p(h|v) and activations h ~ p(h|v)
 
         Uses directed weight "weight_v_to_h" and bias "bias_h"
         
         Args: 
-           visible_minibatch: shape is (size of mini-batch, size of visible layer)
+           visible_minibatch: shape is (size of mini-batch, size of visible layer), dense or scipy sparse
+           out: optional pair of preallocated arrays for probabilities and activations, see 'get_h_given_v'
         Returns:        
            tuple ( p(h|v) , h) 
            both are shaped (size of mini-batch, size of hidden layer)
@@ -272,12 +832,15 @@ class RestrictedBoltzmannMachine:
         # [TODO TASK 4.2] perform same computation as the function 'get_h_given_v'
         #  but with directed connections (replace the zeros below)
 
-        p_h_given_v_dir = sigmoid(visible_minibatch @ self.weight_v_to_h + self.bias_h)
-        h = sample_binary(p_h_given_v_dir)
+        if out is not None:
+            return self._sigmoid_layer_inplace(visible_minibatch, self.weight_v_to_h, self.bias_h, out)
+
+        p_h_given_v_dir = sigmoid(dot(visible_minibatch, self.weight_v_to_h) + self.bias_h)
+        h = sample_binary(p_h_given_v_dir, rand=self.random.uniform(p_h_given_v_dir.shape))
 
         return p_h_given_v_dir, h
 
-    def get_v_given_h_dir(self, hidden_minibatch):
+    def get_v_given_h_dir(self, hidden_minibatch, out=None):
 
         """Compute probabilities p(v|h) and activations v ~ p(v|h)
 
@@ -285,6 +848,7 @@ class RestrictedBoltzmannMachine:
         
         Args: 
            hidden_minibatch: shape is (size of mini-batch, size of hidden layer)
+           out: optional pair of preallocated arrays for probabilities and activations, see 'get_h_given_v'
         Returns:        
            tuple ( p(v|h) , v) 
            both are shaped (size of mini-batch, size of visible layer)
@@ -320,8 +884,11 @@ class RestrictedBoltzmannMachine:
             # DONE
             # [TODO TASK 4.2] performs same computaton as the function 'get_v_given_h' but
             #  with directed connections (replace the pass and zeros below)
+            if out is not None:
+                return self._sigmoid_layer_inplace(hidden_minibatch, self.weight_h_to_v, self.bias_v, out)
+
             p_v_given_h_dir = sigmoid(hidden_minibatch @ self.weight_h_to_v + self.bias_v)
-            s = sample_binary(p_v_given_h_dir)
+            s = sample_binary(p_v_given_h_dir, rand=self.random.uniform(p_v_given_h_dir.shape))
 
         return p_v_given_h_dir, s
 
@@ -340,11 +907,14 @@ class RestrictedBoltzmannMachine:
         # [TODO TASK 4.3] find the gradients from the arguments (replace the 0s below)
         #  and update the weight and bias parameters.
 
-        self.delta_weight_h_to_v = self.learning_rate * inps.T @ (trgs - preds)
-        self.delta_bias_v = self.learning_rate * (np.sum(trgs - preds, axis=0)) 
-        
-        self.weight_h_to_v += self.delta_weight_h_to_v
-        self.bias_v += self.delta_bias_v
+        if self.workspace is not None:
+            grad_weight, grad_bias = self._directed_gradients_inplace(inps, trgs, preds, "grad_hv", "grad_v", "diff_v")
+        else:
+            grad_weight = inps.T @ (trgs - preds)
+            grad_bias = np.sum(trgs - preds, axis=0)
+
+        self.apply_update("weight_h_to_v", grad_weight)
+        self.apply_update("bias_v", grad_bias)
 
         return
 
@@ -363,10 +933,179 @@ class RestrictedBoltzmannMachine:
         # [TODO TASK 4.3] find the gradients from the arguments (replace the 0s below) and
         #  update the weight and bias parameters.
 
-        self.delta_weight_v_to_h = self.learning_rate * inps.T @ (trgs - preds)
-        self.delta_bias_h = self.learning_rate * (np.sum(trgs - preds, axis=0))
+        if self.workspace is not None:
+            grad_weight, grad_bias = self._directed_gradients_inplace(inps, trgs, preds, "grad_vh", "grad_h", "diff_h")
+        else:
+            grad_weight = inps.T @ (trgs - preds)
+            grad_bias = np.sum(trgs - preds, axis=0)
+
+        self.apply_update("weight_v_to_h", grad_weight)
+        self.apply_update("bias_h", grad_bias)
+
+        return
+
+    def _directed_gradients_inplace(self, inps, trgs, preds, grad_weight, grad_bias, diff):
+
+        """Gradients of 'update_generate_params' / 'update_recognize_params' written into the workspace.
+
+        The error trgs - preds goes into the buffer "diff", the weight gradient into "grad_weight" (allocated on first
+        use, the transposed "grad_hv" is only needed for the generative weights), the bias gradient into "grad_bias".
+        Returns (weight gradient, bias gradient).
+        """
+
+        ws = self.workspace
+        error = np.subtract(trgs, preds, out=ws[diff][:trgs.shape[0]])
+
+        if grad_weight not in ws:
+            ws[grad_weight] = np.empty((inps.shape[1], error.shape[1]), dtype=self.dtype)
+        np.matmul(inps.T, error, out=ws[grad_weight])
+        np.sum(error, axis=0, out=ws[grad_bias])
+
+        return ws[grad_weight], ws[grad_bias]
+
+
+class ParallelTempering:
+    """
+    Parallel tempering sampler of the top rbm of a deep belief net, with the labels at the end of the visible layer
+    clamped. For more details : Desjardins, Courville, Bengio, Vincent, Delalleau (2010). Tempered Markov Chain Monte
+    Carlo for training of Restricted Boltzmann Machines. http://proceedings.mlr.press/v9/desjardins10a.html
+
+    Replica l of every chain samples from p(v,h) ~ exp(-betas[l] * E(v,h)). All replicas of all chains are stacked
+    into one batch, so a Gibbs step is one matrix product per layer. After the hidden layer is sampled, neighbouring
+    replicas (alternately the even and the odd pairs) exchange their inverse temperatures with the Metropolis
+    acceptance probability min(1, exp((betas[l] - betas[l+1]) * (E_l - E_l+1))). The states stay in their rows and
+    only the temperatures move, see "rows".
+    """
+
+    def __init__(self, rbm, visible, n_labels, betas):
+
+        """
+        Args:
+          rbm: the top rbm, sampled with "weight_vh" and its random stream
+          visible: initial visible activations (pen activations followed by the clamped labels) shaped (number of
+          chains, size of visible layer). Every replica starts from them
+          n_labels: number of label units at the end of the visible layer
+          betas: decreasing inverse temperatures, betas[0] = 1 is the distribution of the rbm
+        """
+
+        dtype = rbm.dtype
+        n_chains = visible.shape[0]
+        self.rbm = rbm
+        self.n_labels = n_labels
+        self.betas = np.asarray(betas, dtype=dtype)
+        n_rows = len(self.betas) * n_chains
+
+        self.visible = np.tile(visible.astype(dtype, copy=False), (len(self.betas), 1))
+        self.p_hidden = np.empty((n_rows, rbm.ndim_hidden), dtype=dtype)
+        self.hidden = np.empty((n_rows, rbm.ndim_hidden), dtype=dtype)
+        self.support = np.empty((n_rows, rbm.ndim_visible), dtype=dtype)
+        self.neg_energy = np.empty(n_rows, dtype=dtype)
+        self.hidden_energy = np.empty(n_rows, dtype=dtype)
+
+        self.rows = np.arange(n_rows).reshape(len(self.betas), n_chains)  # row of the replica at betas[l] of chain c
+        self.row_betas = np.repeat(self.betas, n_chains).reshape(-1, 1)  # inverse temperature of every row
+        self.n_steps = 0
+        self.accepted = np.zeros(len(self.betas) - 1, dtype=np.int64)  # accepted swaps of pair (l, l+1)
+        self.attempted = np.zeros(len(self.betas) - 1, dtype=np.int64)
+
+        return
+
+    def step(self):
 
-        self.weight_v_to_h += self.delta_weight_v_to_h
-        self.bias_h += self.delta_bias_h
+        """One Gibbs step of every replica with a swap attempt between the hidden and the visible half-step"""
+
+        rbm, uniform = self.rbm, self.rbm.random.uniform
+        n_pen = rbm.ndim_visible - self.n_labels
+
+        np.matmul(self.visible, rbm.weight_vh, out=self.p_hidden)
+        self.p_hidden += rbm.bias_h
+        self.p_hidden *= self.row_betas
+        sigmoid(self.p_hidden, out=self.p_hidden)
+        sample_binary(self.p_hidden, out=self.hidden, rand=uniform(self.hidden.shape))
+
+        # -E(v,h) = v.(W h + b_v) + h.b_h of the current joint states, the visible support is needed next anyway
+        np.matmul(self.hidden, rbm.weight_vh.T, out=self.support)
+        self.support += rbm.bias_v
+        np.einsum("ij,ij->i", self.visible, self.support, out=self.neg_energy)
+        np.matmul(self.hidden, rbm.bias_h, out=self.hidden_energy)
+        self.neg_energy += self.hidden_energy
+
+        self._swap()
+
+        pen = self.support[:, :n_pen]
+        pen *= self.row_betas
+        sigmoid(pen, out=pen)
+        sample_binary(pen, out=self.visible[:, :n_pen], rand=uniform(pen.shape))
+
+        self.n_steps += 1
+        return
+
+    def _swap(self):
+
+        levels = np.arange(self.n_steps % 2, len(self.betas) - 1, 2)
+        if len(levels) == 0:
+            return
+
+        low, high = self.rows[levels], self.rows[levels + 1]
+        log_ratio = (self.betas[levels] - self.betas[levels + 1]).reshape(-1, 1) * \
+            (self.neg_energy[high] - self.neg_energy[low])
+        accept = self.rbm.random.uniform(low.shape) < np.exp(np.minimum(log_ratio, 0.))
+
+        self.rows[levels], self.rows[levels + 1] = np.where(accept, high, low), np.where(accept, low, high)
+        self.row_betas[self.rows.ravel(), 0] = np.repeat(self.betas, self.rows.shape[1])
+        self.accepted[levels] += np.sum(accept, axis=1)
+        self.attempted[levels] += accept.shape[1]
 
         return
+
+    @property
+    def pen(self):
+
+        """Pen activations of the replicas at inverse temperature 1, shaped (number of chains, size of pen layer)"""
+
+        return self.visible[self.rows[0], :-self.n_labels]
+
+    def acceptance_rates(self):
+
+        """Fraction of accepted swaps between the replicas at betas[l] and betas[l+1], for every l"""
+
+        return self.accepted / np.maximum(self.attempted, 1)
+
+
+def _shared_arrays(shapes, dtype):
+    """
+    Allocate one shared memory block holding arrays of the given shapes, returns (block, list of arrays)
+    """
+    from multiprocessing import shared_memory
+
+    dtype = np.dtype(dtype)
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(sizes)) * dtype.itemsize)
+
+    arrays, offset = [], 0
+    for shape, size in zip(shapes, sizes):
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset * dtype.itemsize))
+        offset += size
+    return shm, arrays
+
+
+def _cd1_parallel_worker(rbm, visible_trainset, grads, worker_id, n_workers, n_steps, seed, barrier):
+    """
+    Worker loop of 'RestrictedBoltzmannMachine.cd1_parallel'. Writes the gradients of its minibatch into "grads"
+    (shared memory) once per step.
+    """
+    ws = rbm.allocate_workspace()
+    rbm.random = RandomStream(seed, dtype=rbm.dtype)
+    ws["grad_vh"], ws["grad_v"], ws["grad_h"] = grads
+
+    step_size = rbm.batch_size * n_workers
+    steps_per_epoch = visible_trainset.shape[0] // step_size
+    try:
+        for step in range(n_steps):
+            index_init = (step % steps_per_epoch) * step_size + worker_id * rbm.batch_size
+            barrier.wait()
+            rbm.cd1_gradients_inplace(visible_trainset[index_init:index_init + rbm.batch_size, :])
+            barrier.wait()
+    except Exception:
+        barrier.abort()  # wake up the parent and the other workers instead of leaving them waiting forever
+        raise
@@ -20,7 +20,8 @@ PLOTTING = True
 if __name__ == "__main__":
 
     image_size = [28, 28]
-    train_imgs, train_lbls, test_imgs, test_lbls = read_mnist(dim=image_size, n_train=60000, n_test=10000)
+    train_imgs, train_lbls, test_imgs, test_lbls = read_mnist(dim=image_size, n_train=60000, n_test=10000,
+                                                              dtype=np.float32, cache_dir="mnist_cache")
 
     ''' restricted boltzmann machine '''
     # print("\nStarting a Restricted Boltzmann Machine..")
@@ -40,8 +41,8 @@ if __name__ == "__main__":
     #     averages.append(rbm.cd1(visible_trainset=train_imgs, n_iterations=ITERATIONS, plotting=PLOTTING))
     # if PLOTTING:
     #     for i, hidden in enumerate([200, 500]):
-    #         plt.plot(range(10, 21), averages[i], label=str(hidden) + " hidden units")
-    #     plt.xticks(range(10, 21))
+    #         plt.plot(range(1, ITERATIONS + 1), averages[i], label=str(hidden) + " hidden units")
+    #     plt.xticks(range(1, ITERATIONS + 1))
     #     plt.xlabel("Epoch")
     #     plt.ylabel("Average Loss rate")
     #     plt.legend()
@@ -51,18 +52,19 @@ if __name__ == "__main__":
 
     print("\nStarting a Deep Belief Net..")
 
-    dbn = DeepBeliefNet(sizes={"vis": image_size[0] * image_size[1], "hid": 500, "pen": 500, "top": 2000, "lbl": 10},
+    dbn = DeepBeliefNet(sizes=[image_size[0] * image_size[1], 500, 500, 2000],
                         image_size=image_size,
                         n_labels=10,
-                        batch_size=20
+                        batch_size=20,
+                        dtype=np.float32
                         )
 
     ''' greedy layer-wise training '''
 
     aux = dbn.train_greedylayerwise(vis_trainset=train_imgs, lbl_trainset=train_lbls, n_iterations=ITERATIONS)
-    # plt.plot(range(10, 21), averages[-1], label="Original RBM")
-    # plt.plot(range(10, 21), aux, label="Greedy RBM")
-    # plt.xticks(range(10, 21))
+    # plt.plot(range(1, ITERATIONS + 1), averages[-1], label="Original RBM")
+    # plt.plot(range(1, ITERATIONS + 1), aux, label="Greedy RBM")
+    # plt.xticks(range(1, ITERATIONS + 1))
     # plt.xlabel("Epoch")
     # plt.ylabel("Average Loss rate")
     # plt.legend()
@@ -72,10 +74,7 @@ if __name__ == "__main__":
 
     dbn.recognize(test_imgs, test_lbls)
     #
-    # for digit in range(10):
-    #     digit_1hot = np.zeros(shape=(1, 10))
-    #     digit_1hot[0, digit] = 1
-    #     dbn.generate(digit_1hot, name="rbms")
+    # dbn.generate(np.eye(10), name="rbms")
 
     ''' fine-tune wake-sleep training '''
 
@@ -85,7 +84,4 @@ if __name__ == "__main__":
 
     dbn.recognize(test_imgs, test_lbls)
     #
-    # for digit in range(10):
-    #     digit_1hot = np.zeros(shape=(1, 10))
-    #     digit_1hot[0, digit] = 1
-    #     dbn.generate(digit_1hot, name="dbn")
+    # dbn.generate(np.eye(10), name="dbn")
@@ -0,0 +1,217 @@
+"""
+Local digit classification service for a trained DeepBeliefNet (stdlib only).
+
+ > python serve.py                                  serve trained_dbn/ on http://127.0.0.1:8000
+ > python serve.py --max-batch 64 --max-wait 5      micro-batches of up to 64 images, waiting at most 5 ms
+
+ POST /predict   {"images": [[784 pixel values], ...]}  ->  {"labels": [...], "probabilities": [[10 values], ...]}
+ GET  /stats     latency percentiles (ms), throughput and batch counters
+
+The weights are loaded once. Concurrent requests are queued and answered in micro-batches by a single worker
+thread: a batch is run as soon as it holds "max batch" images or the oldest request has waited "max wait"
+milliseconds. Recognition is deterministic (DeepBeliefNet.recognize_meanfield), so the answer for an image does not
+depend on the batch it ends up in. See loadgen.py for latency measurements.
+"""
+from util import *
+from dbn import DeepBeliefNet, layer_names
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import collections
+import glob
+import json
+import queue
+import threading
+import time
+
+
+def load_dbn(loc="trained_dbn", image_size=None, n_labels=10, dtype=np.float64):
+    """
+    DeepBeliefNet with the weights saved by 'train_wakesleep_finetune' in "loc". The number of layers and their sizes
+    are read from the files
+    """
+    if image_size is None:
+        image_size = [28, 28]
+
+    def shape(name):
+        return np.load("%s/%s.npy" % (loc, name), mmap_mode='r').shape
+
+    names = layer_names(len(glob.glob("%s/dbn.*.weight_v_to_h.npy" % glob.escape(loc))) + 2)
+    sizes = [shape("dbn.%s--%s.weight_v_to_h" % pair)[0] for pair in zip(names[:-2], names[1:-1])]
+    n_pen_lbl, n_top = shape("rbm.%s+lbl--top.weight_vh" % names[-2])
+
+    dbn = DeepBeliefNet(sizes=sizes + [n_pen_lbl - n_labels, n_top], image_size=image_size, n_labels=n_labels,
+                        batch_size=1, dtype=dtype)
+    dbn.loadfromfile_stack(loc=loc)
+    return dbn
+
+
+class MicroBatcher:
+    """
+    Collects the images of concurrent requests into batches of at most "max_batch" images, waiting at most "max_wait"
+    seconds for a batch to fill, and runs predict(images) -> probabilities once per batch on a worker thread.
+
+    Requests are validated before they join a batch. If predict still fails on a batch, its requests are run one by
+    one, so only the request that fails gets the exception.
+    """
+
+    def __init__(self, predict, max_batch=64, max_wait=0.005, history=10000, ndim_visible=None):
+        self.predict = predict
+        self.ndim_visible = ndim_visible
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=history)  # seconds from submit to result, last "history" requests
+        self.lock = threading.Lock()
+        self.n_requests, self.n_images, self.n_batches = 0, 0, 0
+        self.start_time = time.perf_counter()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def validate(self, images):
+        """
+        Raise ValueError unless "images" is a finite array of at least one image of the visible layer size
+        """
+        if images.ndim != 2 or images.shape[0] == 0:
+            raise ValueError("expected at least one image, got an array shaped %s" % (images.shape,))
+        if self.ndim_visible is not None and images.shape[1] != self.ndim_visible:
+            raise ValueError("expected images of %d values, not %d" % (self.ndim_visible, images.shape[1]))
+        if not np.all(np.isfinite(images)):
+            raise ValueError("images contain non-finite values")
+
+    def submit(self, images):
+        """
+        Queue images shaped (number of images, size of visible layer), returns a future of their probabilities. The
+        future fails with ValueError at once if the images do not pass 'validate'
+        """
+        future = Future()
+        try:
+            self.validate(images)
+        except ValueError as error:
+            future.set_exception(error)
+            return future
+        self.requests.put((images, future, time.perf_counter()))
+        return future
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            elapsed = time.perf_counter() - self.start_time
+            stats = {"requests": self.n_requests, "images": self.n_images, "batches": self.n_batches,
+                     "mean_batch_images": self.n_images / max(self.n_batches, 1),
+                     "requests_per_sec": self.n_requests / elapsed, "images_per_sec": self.n_images / elapsed}
+        for percentile in [50, 90, 99]:
+            stats["p%d_ms" % percentile] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return stats
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        n_images = batch[0][0].shape[0]
+        deadline = batch[0][2] + self.max_wait
+        while n_images < self.max_batch:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.perf_counter(), 0.)))
+            except queue.Empty:
+                break
+            n_images += batch[-1][0].shape[0]
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                probabilities = self.predict(np.concatenate([images for images, _, _ in batch], axis=0))
+            except Exception:
+                probabilities = None
+
+            done, offset = time.perf_counter(), 0
+            for images, future, submitted in batch:
+                if probabilities is not None:
+                    future.set_result(probabilities[offset:offset + images.shape[0]])
+                else:
+                    # the batch failed, a request that fails on its own does not take the others with it
+                    try:
+                        future.set_result(self.predict(images))
+                    except Exception as error:
+                        future.set_exception(error)
+                offset += images.shape[0]
+
+            with self.lock:
+                self.latencies.extend(done - submitted for _, _, submitted in batch)
+                self.n_requests += len(batch)
+                self.n_images += offset
+                self.n_batches += 1
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of a MicroBatcher, set as the "batcher" attribute of the server
+    """
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {"error": "unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._reply(404, {"error": "unknown path %s" % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            images = np.asarray(request["images"], dtype=self.server.dtype).reshape(-1, self.server.ndim_visible)
+            self.server.batcher.validate(images)
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {"error": str(error)})
+            return
+
+        try:
+            probabilities = self.server.batcher.submit(images).result()
+        except Exception as error:
+            self._reply(500, {"error": "%s: %s" % (type(error).__name__, error)})
+            return
+        self._reply(200, {"labels": np.argmax(probabilities, axis=1).tolist(), "probabilities": probabilities.tolist()})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return  # one line per request would dominate the cost of small requests
+
+
+def make_server(dbn, host="127.0.0.1", port=8000, max_batch=64, max_wait=0.005):
+    """
+    HTTP server answering with DeepBeliefNet.recognize_meanfield of "dbn". Port 0 picks a free port
+    (server.server_address). Run it with server.serve_forever()
+    """
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(dbn.recognize_meanfield, max_batch=max_batch, max_wait=max_wait,
+                                  ndim_visible=dbn.sizes["vis"])
+    server.dtype = dbn.dtype
+    server.ndim_visible = dbn.sizes["vis"]
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loc", default="trained_dbn", help="directory of the trained network")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=64, help="largest micro-batch, in images")
+    parser.add_argument("--max-wait", type=float, default=5., help="longest wait for a batch to fill, in ms")
+    args = parser.parse_args()
+
+    server = make_server(load_dbn(args.loc), args.host, args.port, args.max_batch, args.max_wait / 1000.)
+    print("serving %s on http://%s:%d" % (args.loc, *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,204 @@
+"""
+Hyperparameter sweep of single rbms trained with CD-1, run in parallel and cached on disk.
+
+ > python sweep.py                                            default grid on MNIST
+ > python sweep.py --ndim-hidden 200 500 --learning-rate 0.003 0.001 --n-iterations 10
+ > python sweep.py --synthetic --n-train 5000 --plot           synthetic data, save the loss curves as sweep.png
+
+Every combination of the grid values is trained in a pool of "--workers" processes (default: one per core). Each
+finished configuration is stored in "--cache-dir" as '<hash>.npz' (loss curve, weights, biases, training time), keyed
+by a hash of the configuration, the seed, the training data and the training code (rbm.py, util.py and this
+file). Running the sweep again only trains the new or changed points, and nothing trained by older code is reused.
+The results are printed as a table sorted by the final reconstruction loss.
+"""
+from util import *
+from rbm import RestrictedBoltzmannMachine
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+# grid axes in the order of the table columns, with their default values
+GRID = {"ndim_hidden": [200, 500], "batch_size": [20], "learning_rate": [0.001], "momentum": [0.7],
+        "n_iterations": [20]}
+
+
+# sources whose changes invalidate the cached results
+CODE_FILES = ["rbm.py", "util.py", "sweep.py"]
+
+
+def code_digest():
+    """
+    SHA1 of the training code, the files CODE_FILES next to this one
+    """
+    key = hashlib.sha1()
+    for name in CODE_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as _file:
+            key.update(_file.read())
+    return key.hexdigest()
+
+
+def config_key(config, data_digest, seed, code):
+    """
+    Cache key of a configuration trained with "seed" on the data hashed to "data_digest" by the code hashed to "code"
+    """
+    return hashlib.sha1(json.dumps([config, data_digest, seed, code], sort_keys=True).encode()).hexdigest()
+
+
+@contextlib.contextmanager
+def environment_defaults(**values):
+    """
+    Set the environment variables "values" that are not set yet, and restore the environment on exit. Processes
+    started inside inherit them, the caller's environment is left as it was
+    """
+    added = [name for name in values if name not in os.environ]
+    os.environ.update({name: values[name] for name in added})
+    try:
+        yield
+    finally:
+        for name in added:
+            os.environ.pop(name, None)
+
+
+def train_config(config, data_file, cache_file, seed, image_size):
+    """
+    Train one rbm on the memory-mapped training data in "data_file" and store the result in "cache_file". Runs in a
+    worker process
+    """
+    data = np.load(data_file, mmap_mode='r')
+
+    np.random.seed(seed)
+    rbm = RestrictedBoltzmannMachine(ndim_visible=data.shape[1], ndim_hidden=config["ndim_hidden"], is_bottom=True,
+                                     image_size=image_size, batch_size=config["batch_size"], dtype=data.dtype,
+                                     seed=seed)
+    rbm.learning_rate = config["learning_rate"]
+    rbm.momentum = config["momentum"]
+
+    start = time.perf_counter()
+    losses = rbm.cd1(data, n_iterations=config["n_iterations"], in_place=True)
+    elapsed = time.perf_counter() - start
+
+    with open(cache_file + ".tmp", 'wb') as _file:
+        np.savez(_file, losses=np.array(losses), weight_vh=rbm.weight_vh, bias_v=rbm.bias_v, bias_h=rbm.bias_h,
+                 time=elapsed, config=json.dumps(config))
+    os.replace(cache_file + ".tmp", cache_file)
+
+    return cache_file
+
+
+def run_sweep(data, grid, n_workers=None, cache_dir="sweep_cache", seed=0, image_size=None):
+    """
+    Train an rbm for every combination of the values in "grid" (keys as in GRID) on "data", reusing cached results.
+
+    The data is written once to "cache_dir" as a .npy file named after its hash and memory-mapped by the workers.
+    Each worker gets an equal share of the BLAS threads, unless OMP_NUM_THREADS is already set. The variable is only
+    set for the workers of this sweep (BLAS reads it when a worker starts), the environment of the caller is restored
+    afterwards.
+
+    Returns:
+      list of dicts with the "config", the per-epoch "losses", the training "time" in seconds, whether the result was
+      "cached" and the "file" holding the weights, in grid order
+    """
+    if image_size is None:
+        image_size = [28, 28]
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    data_digest = hash_arrays([data]).hexdigest()
+    data_file = os.path.join(cache_dir, "data.%s.npy" % data_digest)
+    if not os.path.exists(data_file):
+        with open(data_file + ".tmp", 'wb') as _file:
+            np.save(_file, data)
+        os.replace(data_file + ".tmp", data_file)
+
+    configs = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    code = code_digest()
+    files = [os.path.join(cache_dir, "%s.npz" % config_key(config, data_digest, seed, code)) for config in configs]
+    cached = [os.path.exists(cache_file) for cache_file in files]
+
+    todo = [(config, cache_file) for config, cache_file, done in zip(configs, files, cached) if not done]
+    print("%d configurations, %d cached, training %d on %d workers" % (len(configs), sum(cached), len(todo),
+                                                                       min(n_workers, max(len(todo), 1))))
+    if todo:
+        n_threads = max(1, os.cpu_count() // min(n_workers, len(todo)))
+        # interleaved progress bars of the workers are unreadable
+        with environment_defaults(OMP_NUM_THREADS=str(n_threads), TQDM_DISABLE="1"):
+            with ProcessPoolExecutor(max_workers=min(n_workers, len(todo)),
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = [pool.submit(train_config, config, data_file, cache_file, seed, image_size)
+                           for config, cache_file in todo]
+                for future in as_completed(futures):
+                    print("finished %s" % future.result())
+
+    results = []
+    for config, cache_file, was_cached in zip(configs, files, cached):
+        with np.load(cache_file) as result:
+            results.append({"config": config, "losses": result["losses"].tolist(), "time": float(result["time"]),
+                            "cached": was_cached, "file": cache_file})
+    return results
+
+
+def print_table(results):
+    """
+    One row per configuration, sorted by the final reconstruction loss
+    """
+    columns = list(results[0]["config"].keys()) if results else []
+    print(" ".join("%13s" % column for column in columns + ["final_loss", "best_loss", "train_time_s", "cached"]))
+    for result in sorted(results, key=lambda result: result["losses"][-1] if result["losses"] else np.inf):
+        losses = result["losses"] or [np.nan]
+        print(" ".join(["%13s" % result["config"][column] for column in columns] +
+                       ["%13.4f" % losses[-1], "%13.4f" % min(losses), "%13.1f" % result["time"],
+                        "%13s" % ("yes" if result["cached"] else "no")]))
+
+
+def plot_losses(results, filename):
+    """
+    Reconstruction loss per epoch of every configuration, saved to "filename"
+    """
+    for result in results:
+        plt.plot(range(1, len(result["losses"]) + 1), result["losses"],
+                 label=", ".join("%s=%s" % item for item in result["config"].items()))
+    plt.xlabel("Epoch")
+    plt.ylabel("Average Loss rate")
+    plt.legend(fontsize="small")
+    plt.savefig(filename)
+    plt.close('all')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ndim-hidden", type=int, nargs="+", default=GRID["ndim_hidden"])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=GRID["batch_size"])
+    parser.add_argument("--learning-rate", type=float, nargs="+", default=GRID["learning_rate"])
+    parser.add_argument("--momentum", type=float, nargs="+", default=GRID["momentum"])
+    parser.add_argument("--n-iterations", type=int, nargs="+", default=GRID["n_iterations"], help="epochs")
+    parser.add_argument("--n-train", type=int, default=60000, help="number of training images")
+    parser.add_argument("--synthetic", action="store_true", help="random MNIST-like images instead of MNIST")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of cores)")
+    parser.add_argument("--cache-dir", default="sweep_cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--plot", action="store_true", help="save the loss curves as sweep.png")
+    args = parser.parse_args()
+
+    image_size = [28, 28]
+    if args.synthetic:
+        from benchmark import synthetic_mnist
+        train_imgs, _ = synthetic_mnist(args.n_train, seed=args.seed)
+    else:
+        train_imgs = read_mnist(dim=image_size, n_train=args.n_train, n_test=0, cache_dir="mnist_cache")[0]
+
+    grid = {"ndim_hidden": args.ndim_hidden, "batch_size": args.batch_size, "learning_rate": args.learning_rate,
+            "momentum": args.momentum, "n_iterations": args.n_iterations}
+    results = run_sweep(train_imgs, grid, n_workers=args.workers, cache_dir=args.cache_dir, seed=args.seed,
+                        image_size=image_size)
+
+    print_table(results)
+    if args.plot:
+        plot_losses(results, "sweep.png")
@@ -1,65 +1,416 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+CHECKPOINT_VERSION = 1
+CHECKPOINT_MAGIC = b"DBNCKPT\0"
+CHECKPOINT_ALIGN = 64  # byte alignment of every array in a checkpoint file
 
-def sigmoid(support):
+# below this fraction of non-zero visible units, sparse products beat dense BLAS over a whole cd1 epoch (measured with
+# benchmark.py, case "cd1_sparse": at MNIST's ~19% the dense path is 25-35% faster, around 5% both break even)
+SPARSE_DENSITY_THRESHOLD = 0.03
+
+
+def sigmoid(support, out=None):
     """
     Sigmoid activation function that finds probabilities to turn ON each unit. 
         
     Args:
       support: shape is (size of mini-batch, size of layer)      
+      out: optional preallocated array (may be "support" itself) to write the probabilities into
     Returns:
       on_probabilities: shape is (size of mini-batch, size of layer)      
     """
 
-    on_probabilities = 1. / (1. + np.exp(-support))
-    return on_probabilities
+    if out is None:
+        return 1. / (1. + np.exp(-support))
+
+    np.negative(support, out=out)
+    np.exp(out, out=out)
+    out += 1.
+    np.reciprocal(out, out=out)
+    return out
 
 
-def softmax(support):
+def softmax(support, out=None):
     """
     Softmax activation function that finds probabilities of each category
         
+    The row maximum is subtracted before exponentiating, so no support overflows exp.
+
     Args:
       support: shape is (size of mini-batch, number of categories)      
+      out: optional preallocated array (may be "support" itself) to write the probabilities into
     Returns:
       probabilities: shape is (size of mini-batch, number of categories)      
     """
 
-    expsup = np.exp(support - np.sum(support, axis=1)[:, None])
-    return expsup / np.sum(expsup, axis=1)[:, None]
+    out = np.subtract(support, np.max(support, axis=1, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= np.sum(out, axis=1, keepdims=True)
+    return out
 
 
-def sample_binary(on_probabilities):
+def sample_binary(on_probabilities, out=None, rand=None):
     """ 
     Sample activations ON=1 (OFF=0) from probabilities sigmoid probabilities
         
     Args:
       on_probabilities: shape is (size of mini-batch, size of layer)
+      out: optional preallocated array to write the activations into
+      rand: optional array of uniform random numbers in [0,1) shaped like "on_probabilities". Drawn from the global
+      numpy random state if not given
     Returns:
       activations: shape is (size of mini-batch, size of layer)      
     """
 
-    activations = 1. * (on_probabilities >= np.random.random_sample(size=on_probabilities.shape))
-    return activations
+    if rand is None:
+        rand = np.random.random_sample(size=on_probabilities.shape)
+
+    if out is None:
+        return (on_probabilities >= rand).astype(on_probabilities.dtype)
 
+    np.greater_equal(on_probabilities, rand, out=out)
+    return out
 
-def sample_categorical(probabilities):
+
+def sample_categorical(probabilities, rand=None, out=None):
     """
     Sample one-hot activations from categorical probabilities
         
     Args:
       support: shape is (size of mini-batch, number of categories)      
+      rand: optional array of uniform random numbers in [0,1), one per row of "probabilities". Drawn from the global
+      numpy random state if not given
+      out: optional preallocated array to write the activations into
     Returns:
       activations: shape is (size of mini-batch, number of categories)      
       :param probabilities:
     """
 
-    cumsum = np.cumsum(probabilities, axis=1)
-    rand = np.random.random_sample(size=probabilities.shape[0])[:, None]
-    activations = np.zeros(probabilities.shape)
-    activations[range(probabilities.shape[0]), np.argmax((cumsum >= rand), axis=1)] = 1
-    return activations
+    n_samples, n_categories = probabilities.shape
+    if rand is None:
+        rand = np.random.random_sample(size=n_samples)
+
+    # the chosen category is the number of cumulative probabilities below "rand". Rounding can leave the last
+    # cumulative probability just below 1, hence the clip
+    category = np.sum(np.cumsum(probabilities, axis=1) < rand.reshape(-1, 1), axis=1)
+    np.minimum(category, n_categories - 1, out=category)
+
+    if out is None:
+        out = np.zeros(probabilities.shape, dtype=probabilities.dtype)
+    else:
+        out[...] = 0.
+    out[np.arange(n_samples), category] = 1.
+    return out
+
+
+def momentum_step(param, velocity, gradient, learning_rate, momentum=0., weight_decay=0.):
+    """
+    Gradient ascent step with momentum and L2 weight decay, in place (sections 9 and 10 of the practical guide):
+
+      velocity = momentum * velocity + learning_rate * (gradient - weight_decay * param)
+      param += velocity
+
+    Args:
+      param: parameter array, updated in place
+      velocity: persistent array shaped like "param", updated in place
+      gradient: gradient of the log likelihood shaped like "param". Used as scratch space, its contents are lost
+      learning_rate: step size
+      momentum: fraction of the previous step added to this one. 0 gives plain steps
+      weight_decay: L2 penalty coefficient
+    """
+
+    gradient *= learning_rate
+    if momentum:
+        velocity *= momentum
+        velocity += gradient
+    else:
+        velocity[...] = gradient
+    if weight_decay:
+        np.multiply(param, learning_rate * weight_decay, out=gradient)
+        velocity -= gradient
+    param += velocity
+
+    return param
+
+
+def label_posterior(support, label_weights, label_bias):
+    """
+    Label probabilities of an rbm whose visible layer ends in one-hot label units, from the free energy of each label
+
+      p(label|data) = softmax_label(b_label + sum_j log(1 + exp(support_j + W_label,j)))
+
+    Args:
+      support: hidden support of the data units only, data @ W[data rows] + b_h, shape is (size of mini-batch, size
+      of hidden layer). Shared by all labels, each label adds its row of "label_weights" to it
+      label_weights: weight rows of the label units, shape is (number of labels, size of hidden layer)
+      label_bias: visible bias of the label units, shape is (number of labels,)
+    Returns:
+      tuple ( labels , probabilities ) shaped (size of mini-batch,) and (size of mini-batch, number of labels)
+    """
+
+    n_labels = label_weights.shape[0]
+    softplus = np.empty_like(support)
+    neg_free_energy = np.empty((support.shape[0], n_labels), dtype=support.dtype)
+    for label in range(n_labels):
+        np.add(support, label_weights[label], out=softplus)
+        np.logaddexp(0., softplus, out=softplus)
+        np.sum(softplus, axis=1, out=neg_free_energy[:, label])
+    neg_free_energy += label_bias
+
+    probabilities = softmax(neg_free_energy, out=neg_free_energy)
+    return np.argmax(probabilities, axis=1), probabilities
+
+
+class RandomStream:
+    """
+    Source of the uniform random numbers for 'sample_binary' and 'sample_categorical'.
+
+    The numbers come from a np.random.Generator seeded through a np.random.SeedSequence, so independent and
+    reproducible streams for rbms, chains or workers are obtained with 'spawn'. They are drawn in "dtype" (float32
+    draws take half the time and memory of float64 ones) into buffers that are reused: an array returned by
+    'uniform' is valid until the next call with the same shape from the same thread. The buffers are local to the
+    thread that asked for them and are freed when it ends, so the threads of a pool do not pin memory on the stream.
+
+    With "prefetch", the numbers for the next call with the same shape are drawn on a background thread while the
+    caller works with the current ones (numpy releases the GIL in the matrix products). Prefetching changes the
+    order of the draws, so a run with prefetch is reproducible but differs from one without. Prefetched numbers are
+    not part of 'state'.
+    """
+
+    def __init__(self, seed=None, dtype=np.float64, prefetch=False):
+        """
+        Args:
+          seed: int, None or np.random.SeedSequence
+          dtype: float32 or float64
+          prefetch: draw the next numbers on a background thread
+        """
+        import threading
+
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.generator = np.random.Generator(np.random.PCG64(self.seed_sequence))
+        self.dtype = np.dtype(dtype)
+        self.prefetch = prefetch
+        self._lock = threading.Lock()
+        self._local = threading.local()  # per thread buffers, see '_thread_buffers'
+        self._generation = 0  # incremented when the state is set, which discards the prefetched numbers
+        self._executor = None
+
+    def spawn(self, n_children):
+        """
+        Independent child streams with the same settings
+        """
+        return [RandomStream(child, self.dtype, self.prefetch) for child in self.seed_sequence.spawn(n_children)]
+
+    def uniform(self, shape):
+        """
+        Uniform random numbers in [0,1) shaped "shape", in a reused buffer
+        """
+        local, key = self._thread_buffers(), tuple(shape)
+
+        if not self.prefetch:
+            if key not in local.buffers:
+                local.buffers[key] = np.empty(shape, dtype=self.dtype)
+            return self._fill(local.buffers[key])
+
+        if key not in local.pending:
+            local.double_buffers[key] = [np.empty(shape, dtype=self.dtype), np.empty(shape, dtype=self.dtype)]
+            local.pending[key] = self._submit(local.double_buffers[key][0])
+        current = local.pending[key].result()
+        buffers = local.double_buffers[key]
+        local.pending[key] = self._submit(buffers[1] if current is buffers[0] else buffers[0])
+        return current
+
+    @property
+    def state(self):
+        """
+        State of the generator (json-serializable), after all pending prefetches
+        """
+        self._wait_prefetch()
+        return self.generator.bit_generator.state
+
+    @state.setter
+    def state(self, state):
+        self._wait_prefetch()
+        self._generation += 1
+        self.generator.bit_generator.state = state
+
+    def __getstate__(self):
+        # locks, threads and buffers are not picklable or not worth copying, the generator state is all that counts
+        state = dict(self.__dict__, generator_state=self.state)
+        for key in ["generator", "_lock", "_local", "_generation", "_executor"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        generator_state = state.pop("generator_state")
+        self.__init__(state["seed_sequence"], state["dtype"], state["prefetch"])
+        self.state = generator_state
+
+    def _thread_buffers(self):
+        """
+        Buffers of the calling thread: "buffers" (shape -> buffer), and with prefetch "double_buffers"
+        (shape -> [buffer, buffer]) and "pending" (shape -> future of the prefetched buffer)
+        """
+        local = self._local
+        if not hasattr(local, "buffers"):
+            local.buffers, local.double_buffers, local.pending = {}, {}, {}
+        if getattr(local, "generation", self._generation) != self._generation:
+            local.pending = {}
+        local.generation = self._generation
+        return local
+
+    def _wait_prefetch(self):
+        # the prefetches of all threads run in order on the single worker of the executor
+        if self._executor is not None:
+            self._executor.submit(lambda: None).result()
+
+    def _fill(self, buffer):
+        with self._lock:
+            return self.generator.random(dtype=self.dtype, out=buffer)
+
+    def _submit(self, buffer):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self._fill, buffer)
+
+
+class MinibatchSampler:
+    """
+    Shuffled minibatches of one or more arrays with the same number of rows, e.g. images and labels.
+
+    Every epoch visits all rows once, in a new random order and in minibatches of "batch_size" rows. If "batch_size"
+    does not divide the number of rows, the last minibatch of the epoch holds the remaining ones. The order of an
+    epoch only depends on the seed and the epoch number, so a run resumed at some epoch and minibatch sees the same
+    minibatches as an uninterrupted one.
+
+    The rows of a minibatch are gathered in increasing order with np.take into contiguous buffers that are reused: the
+    arrays of a minibatch are valid until the next one is drawn. Sparse arrays are indexed instead, which allocates.
+
+    With "block_size", the blocks of "block_size" consecutive rows are visited in random order and the rows within a
+    block in random order, instead of shuffling all rows. A minibatch then comes from one or two blocks, so
+    memory-mapped data is read block by block instead of from all over the file.
+    """
+
+    def __init__(self, arrays, batch_size, seed=None, block_size=None, shuffle=True):
+        """
+        Args:
+          arrays: list of arrays (dense, memory-mapped or scipy sparse) with the same number of rows
+          batch_size: number of rows of a minibatch
+          seed: int or None. Drawn once from fresh entropy if None
+          block_size: shuffle blocks of this many consecutive rows, see above. None shuffles all rows
+          shuffle: set to False to visit the rows in their order
+        """
+        self.arrays = arrays
+        self.n_rows = arrays[0].shape[0]
+        self.batch_size = batch_size
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.block_size = block_size
+        self.shuffle = shuffle
+        self.buffers = [None if issparse(array) else np.empty((batch_size,) + array.shape[1:], dtype=array.dtype)
+                        for array in arrays]
+
+    def __len__(self):
+        """
+        Number of minibatches per epoch
+        """
+        return -(-self.n_rows // self.batch_size)
+
+    def permutation(self, epoch):
+        """
+        Order in which epoch "epoch" visits the rows
+        """
+        if not self.shuffle:
+            return np.arange(self.n_rows)
+
+        generator = np.random.Generator(np.random.PCG64(np.random.SeedSequence(self.seed, spawn_key=(epoch,))))
+        if self.block_size is None:
+            return generator.permutation(self.n_rows)
+
+        order, position = np.empty(self.n_rows, dtype=np.intp), 0
+        for block in generator.permutation(-(-self.n_rows // self.block_size)):
+            start = block * self.block_size
+            size = min(self.block_size, self.n_rows - start)
+            order[position:position + size] = start + generator.permutation(size)
+            position += size
+        return order
+
+    def epoch(self, epoch, start=0):
+        """
+        Generator of the minibatches of epoch "epoch", from the "start"-th on. Each is a tuple with the rows of every
+        array, in the order of "arrays"
+        """
+        order = self.permutation(epoch)
+        for begin in range(start * self.batch_size, self.n_rows, self.batch_size):
+            rows = np.sort(order[begin:begin + self.batch_size])
+            yield tuple(array[rows] if buffer is None else np.take(array, rows, axis=0, out=buffer[:len(rows)])
+                        for array, buffer in zip(self.arrays, self.buffers))
+
+
+def issparse(data):
+    """
+    True if "data" is a scipy sparse matrix
+    """
+    import scipy.sparse
+
+    return scipy.sparse.issparse(data)
+
+
+def density(data, n_rows=1000):
+    """
+    Fraction of non-zero entries, measured on the first "n_rows" rows of dense data
+    """
+    if issparse(data):
+        return data.nnz / float(np.prod(data.shape))
+    sample = data[:n_rows]
+    return np.count_nonzero(sample) / float(sample.size)
+
+
+def to_sparse(data, chunk_size=1000):
+    """
+    Convert dense data (e.g. the output of read_mnist) to a CSR matrix, chunk by chunk so that memory-mapped data
+    is never densely copied as a whole
+    """
+    import scipy.sparse
+
+    if issparse(data):
+        return data.tocsr()
+    return scipy.sparse.vstack([scipy.sparse.csr_matrix(data[start:start + chunk_size])
+                                for start in range(0, data.shape[0], chunk_size)], format="csr")
+
+
+def to_dense(data):
+    """
+    Dense array of (possibly sparse) "data"
+    """
+    return data.toarray() if issparse(data) else data
+
+
+def dot(a, b, out=None):
+    """
+    Matrix product a @ b, optionally written into "out". "a" may be a scipy sparse matrix
+    """
+    if issparse(a):
+        product = np.asarray(a @ b)
+        if out is None:
+            return product
+        out[...] = product
+        return out
+    return np.matmul(a, b, out=out)
+
+
+def column_sum(data, out=None):
+    """
+    Sum over the rows of (possibly sparse) "data", optionally written into "out"
+    """
+    if issparse(data):
+        total = np.asarray(data.sum(axis=0)).ravel()
+        if out is None:
+            return total
+        out[...] = total
+        return out
+    return np.sum(data, axis=0, out=out)
 
 
 def load_idxfile(filename):
@@ -77,31 +428,182 @@ def load_idxfile(filename):
     return data
 
 
-def read_mnist(dim=None, n_train=60000, n_test=1000):
+def hash_arrays(arrays, key=None, chunk_size=1000):
+    """
+    SHA1 of the shapes, types and contents of "arrays" (None entries are skipped), read "chunk_size" rows at a time
+    so that memory maps are never loaded whole. Continues "key" (a hashlib object) if given, returns the hash object
+    """
+    import hashlib
+
+    if key is None:
+        key = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            continue
+        array = np.asarray(array)
+        key.update(str((array.shape, array.dtype.str)).encode())
+        if array.ndim == 0:
+            key.update(array.tobytes())
+        for start in range(0, len(array) if array.ndim else 0, chunk_size):
+            key.update(np.ascontiguousarray(array[start:start + chunk_size]).data)
+    return key
+
+
+def load_idxfile_cached(filename, convert, tag, cache_dir):
+    """
+    Memory-map the preprocessed contents of an idx file. On first use the file is loaded, passed through "convert" and
+    stored as "<cache_dir>/<filename>.<tag>.npy". The cache is rebuilt whenever the size or modification time of the
+    idx file change. Cache files are written to a temporary name and renamed, so a crashed run never leaves a
+    half-written cache behind.
+    """
+    import os
+
+    stat = os.stat(filename)
+    stamp = "%d %d" % (stat.st_size, stat.st_mtime_ns)
+    cache_file = os.path.join(cache_dir, "%s.%s.npy" % (os.path.basename(filename), tag))
+    stamp_file = cache_file + ".stamp"
+
+    try:
+        with open(stamp_file) as _file:
+            valid = _file.read() == stamp and os.path.exists(cache_file)
+    except IOError:
+        valid = False
+
+    if not valid:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + ".tmp", 'wb') as _file:
+            np.save(_file, convert(load_idxfile(filename)))
+        os.replace(cache_file + ".tmp", cache_file)
+        with open(stamp_file + ".tmp", 'w') as _file:
+            _file.write(stamp)
+        os.replace(stamp_file + ".tmp", stamp_file)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+def read_mnist(dim=None, n_train=60000, n_test=1000, dtype=np.float64, cache_dir=None):
     """
     Read mnist train and test data. Images are normalized to be in range [0,1]. Labels are one-hot coded.
+    Both are returned as "dtype" arrays.
+
+    If "cache_dir" is given, the normalized arrays are cached there as float32 on first use (see
+    'load_idxfile_cached'), whatever "dtype" is. For float32 they are returned as read-only memory maps, so startup
+    does not depend on the dataset size and slicing does not copy; other dtypes get a converted copy of the requested
+    rows only.
     """
     if dim is None:
         dim = [28, 28]
     import scipy.misc
 
-    train_imgs = load_idxfile("train-images-idx3-ubyte")
-    train_imgs = train_imgs / 255.
-    train_imgs = train_imgs.reshape(-1, dim[0] * dim[1])
+    def normalize(imgs, dtype=dtype):
+        return (imgs.astype(dtype) / np.array(255., dtype=dtype)).reshape(-1, dim[0] * dim[1])
+
+    def one_hot(lbls, dtype=dtype):
+        lbls_1hot = np.zeros((len(lbls), 10), dtype=dtype)
+        lbls_1hot[range(len(lbls)), lbls] = 1.
+        return lbls_1hot
+
+    def load(filename, convert, n_rows):
+        if cache_dir is None:
+            return convert(load_idxfile(filename))[:n_rows]
+        tag = "float32.%s" % ("x".join(str(d) for d in dim) if convert is normalize else "1hot")
+        cached = load_idxfile_cached(filename, lambda data: convert(data, np.float32), tag, cache_dir)[:n_rows]
+        return cached if cached.dtype == dtype else cached.astype(dtype)
+
+    train_imgs = load("train-images-idx3-ubyte", normalize, n_train)
+    train_lbls_1hot = load("train-labels-idx1-ubyte", one_hot, n_train)
+    test_imgs = load("t10k-images-idx3-ubyte", normalize, n_test)
+    test_lbls_1hot = load("t10k-labels-idx1-ubyte", one_hot, n_test)
+
+    return train_imgs, train_lbls_1hot, test_imgs, test_lbls_1hot
+
+
+def save_checkpoint(filename, arrays, meta):
+    """
+    Write named arrays and a json-serializable dictionary "meta" into a single checkpoint file.
+
+    Layout: CHECKPOINT_MAGIC, header length (little endian uint64), json header with version, meta and the dtype,
+    shape and offset of every array, then the raw arrays, each aligned to CHECKPOINT_ALIGN bytes so that
+    'load_checkpoint' can memory-map them. The file is written under a temporary name and renamed, so "filename"
+    always holds either the previous or the new checkpoint, never a partial one.
+    """
+    import json
+    import os
+    import struct
+
+    index, size = {}, 0
+    for key, array in arrays.items():
+        size = -(-size // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+        index[key] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": size}
+        size += array.nbytes
+    header = json.dumps({"version": CHECKPOINT_VERSION, "meta": meta, "arrays": index}).encode()
+    data_start = _checkpoint_data_start(len(header))
+
+    with open(filename + ".tmp", 'wb') as _file:
+        _file.write(CHECKPOINT_MAGIC)
+        _file.write(struct.pack("<Q", len(header)))
+        _file.write(header)
+        for key, array in arrays.items():
+            _file.seek(data_start + index[key]["offset"])
+            _file.write(np.ascontiguousarray(array).data)
+        _file.truncate(data_start + size)
+        _file.flush()
+        os.fsync(_file.fileno())
+    os.replace(filename + ".tmp", filename)
+
+
+def load_checkpoint(filename):
+    """
+    Read a file written by 'save_checkpoint'. The arrays are copy-on-write memory maps: they are only read from disk
+    when used, and changing them does not change the file.
+
+    Returns:
+      tuple (dictionary of arrays, meta)
+    """
+    import json
+    import struct
+
+    with open(filename, 'rb') as _file:
+        if _file.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+            raise IOError('Invalid checkpoint file: unexpected magic number!')
+        header_length, = struct.unpack("<Q", _file.read(8))
+        header = json.loads(_file.read(header_length).decode())
+
+    if header["version"] > CHECKPOINT_VERSION:
+        raise IOError('Checkpoint version %d is newer than the supported version %d'
+                      % (header["version"], CHECKPOINT_VERSION))
+
+    data_start = _checkpoint_data_start(header_length)
+    arrays = {}
+    for key, entry in header["arrays"].items():
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        if np.prod(shape) == 0:
+            arrays[key] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[key] = np.memmap(filename, dtype=dtype, mode='c', offset=data_start + entry["offset"],
+                                    shape=shape).view(np.ndarray)
+    return arrays, header["meta"]
 
-    train_lbls = load_idxfile("train-labels-idx1-ubyte")
-    train_lbls_1hot = np.zeros((len(train_lbls), 10), dtype=np.float32)
-    train_lbls_1hot[range(len(train_lbls)), train_lbls] = 1.
 
-    test_imgs = load_idxfile("t10k-images-idx3-ubyte")
-    test_imgs = test_imgs / 255.
-    test_imgs = test_imgs.reshape(-1, dim[0] * dim[1])
+def _checkpoint_data_start(header_length):
+    return -(-(len(CHECKPOINT_MAGIC) + 8 + header_length) // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
 
-    test_lbls = load_idxfile("t10k-labels-idx1-ubyte")
-    test_lbls_1hot = np.zeros((len(test_lbls), 10), dtype=np.float32)
-    test_lbls_1hot[range(len(test_lbls)), test_lbls] = 1.
 
-    return train_imgs[:n_train], train_lbls_1hot[:n_train], test_imgs[:n_test], test_lbls_1hot[:n_test]
+def get_random_state():
+    """
+    State of the global numpy random generator, split into arrays and meta for 'save_checkpoint'
+    """
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {"random_state.key": key}, {"name": name, "pos": int(pos), "has_gauss": int(has_gauss),
+                                       "cached_gaussian": float(cached_gaussian)}
+
+
+def set_random_state(arrays, meta):
+    """
+    Restore the global numpy random generator from the output of 'get_random_state'
+    """
+    np.random.set_state((meta["name"], np.asarray(arrays["random_state.key"]), meta["pos"], meta["has_gauss"],
+                         meta["cached_gaussian"]))
 
 
 def viz_rf(weights, epoch, grid):
@@ -127,3 +629,102 @@ def stitch_video(fig, imgs):
     import matplotlib.animation as animation
 
     return animation.ArtistAnimation(fig, imgs, interval=100, blit=True, repeat=False)
+
+
+def render_generated(records, image_size, name, digits, n_samples=1):
+    """
+    Render the output of 'DeepBeliefNet.generate_batch'. Saves "<name>.generate<digit>.mp4" per label, each frame
+    showing the "n_samples" chains of that label side by side, and "<name>.generate.png" with the last recorded state
+    of all chains (one row per label).
+    """
+    n_records = records.shape[0]
+    # (records, labels, samples, height, width) -> (records, labels, height, samples * width)
+    frames = records.reshape(n_records, len(digits), n_samples, image_size[0], image_size[1])
+    frames = frames.transpose(0, 1, 3, 2, 4).reshape(n_records, len(digits), image_size[0], -1)
+
+    for i, digit in enumerate(digits):
+        fig, ax = plt.subplots(1, 1, figsize=(3 * n_samples, 3))
+        plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        imgs = [[ax.imshow(frame, cmap="bwr", vmin=0, vmax=1, animated=True, interpolation=None)]
+                for frame in frames[:, i]]
+        stitch_video(fig, imgs).save("%s.generate%d.mp4" % (name, digit))
+        plt.close(fig)
+
+    fig, ax = plt.subplots(1, 1, figsize=(n_samples, len(digits)))
+    plt.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.imshow(frames[-1].reshape(-1, frames.shape[-1]), cmap="bwr", vmin=0, vmax=1, interpolation=None)
+    plt.savefig("%s.generate.png" % name)
+    plt.close('all')
+
+
+class VisualizationSink:
+    """
+    Renders figures (calls of functions like 'viz_rf' or 'render_generated') in a separate process, so that training
+    does not wait for matplotlib.
+
+    'submit' copies nothing itself: pass copies of arrays that keep changing (a slice with a list of indices, like the
+    receptive fields of a weight matrix, already is one). Jobs go through a queue of at most "max_pending" entries.
+    When it is full, the job is kept back instead of blocking, and a later job with the same "key" replaces it
+    (coalescing, the replaced one is counted in "dropped"). Kept back jobs are sent on the next 'submit' or on
+    'close'.
+    """
+
+    def __init__(self, max_pending=4):
+        import multiprocessing
+
+        ctx = multiprocessing.get_context("spawn")  # matplotlib and forked BLAS threads do not mix well
+        self.queue = ctx.Queue(maxsize=max_pending)
+        self.process = ctx.Process(target=_visualization_worker, args=(self.queue,), daemon=True)
+        self.process.start()
+        self.held = {}  # key -> job kept back while the queue was full
+        self.submitted, self.dropped = 0, 0
+
+    def submit(self, func, *args, key=None):
+        """
+        Render func(*args) in the worker process. Never blocks. "func" must be a module level function
+        """
+        import queue
+
+        if key is None:
+            key = object()  # never coalesced
+        if key in self.held:
+            self.dropped += 1
+        self.held[key] = (func, args)
+
+        for held_key in list(self.held):
+            try:
+                self.queue.put_nowait(self.held[held_key])
+            except queue.Full:
+                break
+            del self.held[held_key]
+            self.submitted += 1
+
+    def close(self):
+        """
+        Send the jobs kept back, wait until everything is rendered and stop the worker process
+        """
+        for job in self.held.values():
+            self.queue.put(job)
+            self.submitted += 1
+        self.held = {}
+        self.queue.put(None)
+        self.process.join()
+
+
+def _visualization_worker(jobs):
+    """
+    Loop of the 'VisualizationSink' process. A failing job is reported and skipped
+    """
+    import traceback
+
+    plt.switch_backend("Agg")
+    for job in iter(jobs.get, None):
+        func, args = job
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()